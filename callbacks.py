@@ -1,6 +1,6 @@
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
-from dash import dcc
+from dash import dcc, Patch
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 import data_processing
@@ -8,20 +8,165 @@ import utils
 import os
 import eclabfiles as ecf
 import pandas as pd
-import nmrglue as ng
+import numpy as np
 from datetime import datetime, timedelta
 import plotting
+import live
+import refresh
+import spectral_stack
+import decimation
+import phasing
+import jobs
+import stages
+import watcher
 import dash
 from dash import callback_context
-from tqdm import tqdm
 
 def register_callbacks(app):
+    def load_data(job, nmr_folder, voltage_folder, ppm_min, ppm_max, format_type, nucleus, data_selector,
+                  live_time_window, past_start_datetime, past_end_datetime, session_id):
+        """Handles of the data stages of every panel, run in the job pool and reporting its stages to the progress bar.
+
+        Each stage is memoized by its own inputs, a refresh in which nothing arrived only lists the folders.
+        """
+        no_data = {'spectra_handle': None, 'voltage_handle': None, 'cycle_handle': None, 'first_last_handle': None,
+                   'fid_handle': None}
+        if not all([nmr_folder, voltage_folder, ppm_min, ppm_max, format_type, nucleus, data_selector, live_time_window,
+                    past_start_datetime, past_end_datetime]):
+            return dict(no_data, message="Incomplete or invalid input. Please check your inputs.")
+
+        if ppm_min > ppm_max:
+            return dict(no_data, message="ppm min > ppm max, Choose a valid ppm range")
+
+        try:
+            ppm_min, ppm_max = float(ppm_min), float(ppm_max)
+
+            job.progress('Listing spectra', 0)
+            # Every stage takes its data from this context, so nothing is listed, read or processed twice
+            data_context = refresh.RefreshContext(nmr_folder, nucleus, format_type, voltage_folder)
+
+            if data_selector == 'live':
+                end_datetime = data_context.latest()
+                if end_datetime is None:
+                    raise ValueError("No NMR spectra found in the specified folder, or incorrect spectra naming (eg. 1H_20231101T000823.fid).")
+                start_datetime = end_datetime - utils.datetime.timedelta(hours=float(live_time_window))
+            elif data_selector == 'past':
+                # Calculate past time range based on user input
+                start_datetime = datetime.strptime(past_start_datetime, '%Y-%m-%d %H:%M')
+                end_datetime = datetime.strptime(past_end_datetime, '%Y-%m-%d %H:%M')
+            elif data_selector != 'live' and data_selector != 'past':
+                raise ValueError('dataselector: ', data_selector)
+
+
+            # Find NMR spectra in the calculated time range
+            spectra_paths = data_context.select(start_datetime, end_datetime)
+            print(f'finding nmr spectra in time range: {start_datetime},{end_datetime}')
+            if not spectra_paths:
+                raise ValueError("No NMR spectra in the selected time range.")
+            selection = stages.memoize(stages.stage_handle('selection', nmr_folder, nucleus, spectra_paths),
+                                       lambda: list(spectra_paths))
+
+            job.progress('Phasing', 5)
+            # One phase for the whole series, estimated on co-added spectra and only re-estimated when it drifts
+            phase_params = data_context.phase()
+
+            # Only the region around the ppm range is kept, zooming within it reuses the processed region
+            roi = data_processing.roi_bounds(ppm_min, ppm_max)
+
+            def build_spectra():
+                if data_selector == 'live':
+                    # Keep the spectra processed on earlier ticks, only the ones that arrived since are processed
+                    series = live.get_series(session_id, (nmr_folder, nucleus, format_type, phase_params, roi))
+                    series.drop_before(start_datetime)
+                else:
+                    series = live.SpectrumSeries(None)
+
+                new_paths = series.new_paths(spectra_paths)
+                new_spectra = data_context.spectra(new_paths, roi, job.steps('Processing spectra', 10, 70))
+                # A replaced job stops here, before it touches the live series of the session
+                job.progress('Reading voltage data', 70)
+                series.extend(new_paths, new_spectra)
+                # A view of the rows of this selection, later ticks append to the series without changing it
+                return series.window(*roi)
+
+            spectra = stages.spectra_handle(selection, format_type, phase_params, roi)
+            nmr_times = stages.fetch(spectra, build_spectra).times
+
+            job.progress('Reading voltage data', 70)
+            frames = stages.memoize(stages.stage_handle('eclab', voltage_folder,
+                                                        data_processing.eclab_folder_key(voltage_folder)),
+                                    data_context.eclab)
+
+            # Get the true start time (timestamp of the first spectrum in the folder)
+            experiment_start_time = data_context.start_time()
+
+            job.progress('First and last spectra', 85)
+            first_spectrum_path, last_spectrum_path = data_context.first_last()
+
+            # Full spectra with the series phase, the same ones the heatmap region was cut from
+            first_last_paths = [path for path in (first_spectrum_path, last_spectrum_path) if path]
+            first_last = stages.memoize(
+                stages.stage_handle('first_last', first_last_paths, format_type, phase_params),
+                lambda: spectral_stack.SpectralStack.from_results(first_last_paths,
+                                                                  data_context.spectra(first_last_paths)))
+
+            job.progress('FID', 92)
+            fid = stages.memoize(
+                stages.stage_handle('fid', last_spectrum_path, format_type,
+                                    utils.spectrum_fingerprint(last_spectrum_path)),
+                lambda: data_context.fid(last_spectrum_path))
+
+            # Each panel only rebuilds when its own handle changes
+            return {
+                'spectra_handle': {
+                    'handle': spectra,
+                    'selection': selection,
+                    'nmr_folder': nmr_folder,
+                    'nucleus': nucleus,
+                    'live': data_selector == 'live',
+                    'format_type': format_type,
+                    'phase': list(phase_params),
+                    'roi': list(roi),
+                    'start': start_datetime.isoformat(),
+                    'end': end_datetime.isoformat(),
+                    'experiment_start': experiment_start_time.isoformat(),
+                },
+                'voltage_handle': {
+                    'frames': frames,
+                    'voltage_folder': voltage_folder,
+                    'start': start_datetime.isoformat(),
+                    'end': end_datetime.isoformat(),
+                    'experiment_start': experiment_start_time.isoformat(),
+                },
+                'cycle_handle': {
+                    'frames': frames,
+                    'voltage_folder': voltage_folder,
+                },
+                'first_last_handle': {
+                    'handle': first_last,
+                    'paths': first_last_paths,
+                    'format_type': format_type,
+                    'phase': list(phase_params),
+                    'start': min(nmr_times).isoformat(),
+                    'end': max(nmr_times).isoformat(),
+                },
+                'fid_handle': {
+                    'handle': fid,
+                    'path': last_spectrum_path,
+                    'format_type': format_type,
+                },
+                'message': "",
+            }
+
+        except jobs.JobCancelled:
+            raise
+        except Exception as e:
+            print(f"Error in heatmap callback: {e}")
+            return dict(no_data, message="")
+
     @app.callback(
-        [Output('nmr_plot', 'figure'),
-         Output('first_last_spectrum_plot', 'figure'),
-         Output('fid_plot', 'figure'),
-         Output('cycle_plot', 'figure'),
-         Output('message_area', 'children'),],
+        [Output('refresh_job', 'data'),
+         Output('job_poll', 'disabled', allow_duplicate=True)],
         [State('dummy_div', 'children'),
          State('nmr_folder_input', 'value'),
          State('voltage_folder_input', 'value'),
@@ -32,245 +177,356 @@ def register_callbacks(app):
          State('data_selector', 'value'),
          State('live_time_window_input', 'value'),
          State('past_start_datetime', 'value'),
-         State('past_end_datetime','value')],
+         State('past_end_datetime','value'),
+         State('session_id', 'data')],
          [Input('update_button', 'n_clicks'),
-         Input('interval-component', 'n_intervals')
+         Input('data_version', 'data')
          ],
+        prevent_initial_call=True
     )
 
     def update_plots(_, nmr_folder, voltage_folder, ppm_min, ppm_max, format_type,
-                     nucleus, data_selector, live_time_window, past_start_datetime, past_end_datetime, n_clicks, n_intervals):
+                     nucleus, data_selector, live_time_window, past_start_datetime, past_end_datetime, session_id,
+                     n_clicks, data_version):
         ctx = callback_context
 
         # Identify what triggered the callback
         trigger_id = ctx.triggered[0]['prop_id'].split('.')[0]
+        if trigger_id != 'update_button' and trigger_id != 'data_version':
+            print("Callback triggered by an unexpected source.")
+            raise PreventUpdate
 
-        if not all([nmr_folder, voltage_folder, ppm_min, ppm_max, format_type, nucleus, data_selector, live_time_window,
-                    past_start_datetime, past_end_datetime]):
-            error_message = "Incomplete or invalid input. Please check your inputs."
-            return go.Figure(), go.Figure(), go.Figure(), error_message
+        # Loading runs in the job pool, a refresh with other inputs replaces the running one of this session
+        inputs = (nmr_folder, voltage_folder, ppm_min, ppm_max, format_type, nucleus, data_selector, live_time_window,
+                  past_start_datetime, past_end_datetime)
+        # A running refresh listed the folder before the watcher saw the new data, so a new version replaces it
+        key = inputs + (data_version,) if trigger_id == 'data_version' else inputs
+        job = jobs.submit((session_id, 'refresh'), key, load_data, *inputs, session_id)
+        return job.id, False
 
+    @app.callback(
+        Output('data_version', 'data'),
+        Input('interval-component', 'n_intervals'),
+        [State('nmr_folder_input', 'value'),
+         State('voltage_folder_input', 'value'),
+         State('data_selector', 'value'),
+         State('data_version', 'data')],
+        prevent_initial_call=True
+    )
+    def check_for_data(n_intervals, nmr_folder, voltage_folder, data_selector, data_version):
+        # Cheap poll of the folder watcher, a live refresh only starts when new data arrived
+        if data_selector != 'live' or not nmr_folder or not os.path.isdir(nmr_folder):
+            raise PreventUpdate
+        folder_watcher = watcher.get_watcher(nmr_folder, voltage_folder)
+        # Count 0 means the watcher has not finished its first look at the folders
+        if folder_watcher.count == 0 or folder_watcher.version == data_version:
+            raise PreventUpdate
+        return folder_watcher.version
+
+    @app.callback(
+        [Output('progress-bar', 'value'),
+         Output('progress-bar', 'label'),
+         Output('job_poll', 'disabled'),
+         Output('spectra_handle', 'data'),
+         Output('voltage_handle', 'data'),
+         Output('cycle_handle', 'data'),
+         Output('first_last_handle', 'data'),
+         Output('fid_handle', 'data'),
+         Output('message_area', 'children'),
+         Output('int-plot', 'figure')],
+        Input('job_poll', 'n_intervals'),
+        [State('refresh_job', 'data'),
+         State('integration_job', 'data'),
+         State('spectra_handle', 'data'),
+         State('voltage_handle', 'data'),
+         State('cycle_handle', 'data'),
+         State('first_last_handle', 'data'),
+         State('fid_handle', 'data')],
+        prevent_initial_call=True
+    )
+    def poll_jobs(n_intervals, refresh_job_id, integration_job_id, *current_handles):
+        # Deliver the results of finished jobs and show the stage of the one still running
+        handle_names = ('spectra_handle', 'voltage_handle', 'cycle_handle', 'first_last_handle', 'fid_handle')
+        refresh_outputs = [dash.no_update] * 6
+        integration_output = dash.no_update
+        running = None
+
+        job = jobs.get_job(refresh_job_id)
+        if job is not None and job.done():
+            try:
+                loaded = jobs.collect(refresh_job_id)
+            except Exception as e:
+                print(f"Error in refresh job: {e}")
+                loaded = dict(dict.fromkeys(handle_names), message="")
+            # Handles that did not change are not sent, so only the panels whose data changed rebuild
+            refresh_outputs = [dash.no_update if loaded[name] == current else loaded[name]
+                               for name, current in zip(handle_names, current_handles)]
+            refresh_outputs.append(loaded['message'])
+        elif job is not None:
+            running = job
+
+        job = jobs.get_job(integration_job_id)
+        if job is not None and job.done():
+            try:
+                integration_output = jobs.collect(integration_job_id)
+            except Exception as e:
+                print(f"Error in integration job: {e}")
+                integration_output = go.Figure()
+        elif job is not None:
+            running = running or job
+
+        if running is None:
+            return [100, "", True] + refresh_outputs + [integration_output]
+        return [running.percent, f"{running.stage} ({running.percent}%)", False] + refresh_outputs + [integration_output]
+
+    @app.callback(
+        [Output('nmr_plot', 'figure'),
+         Output('message_area', 'children', allow_duplicate=True)],
+        [Input('spectra_handle', 'data'),
+         Input('voltage_handle', 'data'),
+         Input('ppm_min_input', 'value'),
+         Input('ppm_max_input', 'value')],
+        State('session_id', 'data'),
+        prevent_initial_call=True
+    )
+    def update_nmr_plot(spectra_handle, voltage_handle, ppm_min, ppm_max, session_id):
+        if not spectra_handle or not voltage_handle:
+            live.drop_view(session_id)
+            return go.Figure(), dash.no_update
+        if ppm_min is None or ppm_max is None:
+            return dash.no_update, "Incomplete or invalid input. Please check your inputs."
         if ppm_min > ppm_max:
-            error_message = "ppm min > ppm max, Choose a valid ppm range"
-            return go.Figure(), go.Figure(), go.Figure(), error_message
+            return dash.no_update, "ppm min > ppm max, Choose a valid ppm range"
 
         try:
-            if trigger_id == 'update_button' or trigger_id == 'interval-component':
-                ppm_min, ppm_max = float(ppm_min), float(ppm_max)
+            ppm_min, ppm_max = float(ppm_min), float(ppm_max)
+
+            # The loaded region is reused while the ppm range stays inside it, otherwise the new region is processed
+            roi = data_processing.roi_bounds(ppm_min, ppm_max)
+            series = stages.spectra(spectra_handle, roi)
+            experiment_start_time = datetime.fromisoformat(spectra_handle['experiment_start'])
+
+            print('Plotting voltage trace')
+            ec_v_df = stages.eclab(voltage_handle)[1]
+            volt_df = data_processing.eclab_voltage(ec_v_df, datetime.fromisoformat(voltage_handle['start']),
+                                                    datetime.fromisoformat(voltage_handle['end']))
+
+            # The desired ppm range as a view of the stack, nothing is copied before the heatmap is binned
+            heatmap_stack = series.window(ppm_min, ppm_max)
+
+            if spectra_handle['live']:
+                # A live tick of the same figure only sends the rows and voltage points that were added
+                view = live.get_view(session_id, (spectra_handle['nmr_folder'], spectra_handle['nucleus'],
+                                                  spectra_handle['format_type'], tuple(spectra_handle['phase']),
+                                                  ppm_min, ppm_max, spectra_handle['experiment_start'],
+                                                  voltage_handle['voltage_folder']))
+                patch = view.patch(heatmap_stack, volt_df, datetime.fromisoformat(voltage_handle['start']),
+                                   datetime.fromisoformat(voltage_handle['end']), experiment_start_time)
+                if patch is not None:
+                    return patch, ""
+            else:
+                live.drop_view(session_id)
 
-                if data_selector == 'live':
-                    end_datetime = utils.get_most_recent_time(nmr_folder)
-                    if end_datetime is None:
-                        raise ValueError("No NMR spectra found in the specified folder, or incorrect spectra naming (eg. 1H_20231101T000823.fid).")
-                    start_datetime = end_datetime - utils.datetime.timedelta(hours=float(live_time_window))
-                elif data_selector == 'past':
-                    # Calculate past time range based on user input
-                    start_datetime = datetime.strptime(past_start_datetime, '%Y-%m-%d %H:%M')
-                    end_datetime = datetime.strptime(past_end_datetime, '%Y-%m-%d %H:%M')
-                elif data_selector != 'live' and data_selector != 'past':
-                    raise ValueError('dataselector: ', data_selector)
-
-
-                # Find NMR spectra in the calculated time range
-                spectra_paths = data_processing.find_spectra_in_range(nmr_folder, start_datetime, end_datetime, nucleus)
-                spectra_paths = sorted(spectra_paths)
-                print(f'finding nmr spectra in time range: {start_datetime},{end_datetime}')
-                # Extract times for the first and last NMR spectra
-                nmr_times = [data_processing.extract_date_time(path) for path in spectra_paths]
-                nmr_start_time, nmr_end_time = min(nmr_times), max(nmr_times)
-
-                print('Plotting voltage trace')
-                eclab_df = data_processing.process_eclab(voltage_folder)
-                ec_v_df = eclab_df[1]
-                volt_df = data_processing.eclab_voltage(ec_v_df, start_datetime, end_datetime)
-                print("Columns in volt_df:", volt_df.columns)
-                print("First few rows of volt_df:", volt_df.head())
-
-                autophase_done = False
-                phase_params = (None, None)
-
-                heatmap_intensity = []
-                spectrum_runtime = []
-                ppm_values = None
-                progress_bar = tqdm(total=len(spectra_paths), desc="Processing Spectra")
-                for index, path in enumerate(spectra_paths):
-                    # Ensure correct argument passing. Adjust according to the updated function signature
-                    if not autophase_done:
-                        # For the first spectrum, apply autophasing
-                        dic, data, p0, p1, runtime, obs, sw, car = data_processing.process_nmr_data(
-                            path=path,
-                            nmr_format=format_type,
-                            apply_autophase=False,
-                            #apply_autophase=True,
-                            #p0=0,
-                            #p1=0,
-                            #custom phasing parameters below override autophase...
-                            p0=-260.143324985434,
-                            p1=26.94935982565039
-                        )
-                        # Store phase parameters from the first spectrum for subsequent use
-                        phase_params = (p0, p1)
-                        autophase_done = True
-                    else:
-                        # For subsequent spectra, use stored phase parameters without autophasing
-                         dic, data, p0, p1, runtime, obs, sw, car = data_processing.process_nmr_data(
-                            path=path,
-                            nmr_format=format_type,
-                            apply_autophase=False,
-                            p0=phase_params[0],
-                            p1=phase_params[1]
-                        )
-
-                    spectrum_runtime.append(runtime)
-
-                    if ppm_values is None:
-                        uc = ng.pipe.make_uc(dic, data)
-                        ppm_values = uc.ppm_scale()
-
-                    intensity = data.real
-                    heatmap_intensity.append(intensity)
-                    progress_bar.update(1)
-                progress_bar.close()
-
-                # Find the indices for the desired ppm range
-                ppm_indices = [i for i, ppm in enumerate(ppm_values) if ppm_min <= ppm <= ppm_max]
-
-                # Filter the ppm values and intensities according to the indices
-                filtered_ppm_values = [ppm_values[i] for i in ppm_indices]
-                filtered_heatmap_intensity = [[intensity[i] for i in ppm_indices] for intensity in heatmap_intensity]
-                filtered_ppm_values = list(filtered_ppm_values)
-
-                # Create a subplot figure with 2 columns
-                fig = make_subplots(rows=1, cols=2, shared_yaxes=True, column_widths=[0.67, 0.33], horizontal_spacing=0.02)
-
-                # Get the true start time (timestamp of the first spectrum in the folder)
-                true_start_time = utils.find_true_start_time(nmr_folder, nucleus)
-                experiment_start_time = true_start_time
-                print("Creating NMR Heatmap")
-                fig_nmr_heatmap = plotting.create_nmr_heatmap(filtered_ppm_values, nmr_times, filtered_heatmap_intensity, experiment_start_time)
-                # Pass the start time to the voltage trace function
-                fig_voltage_trace = plotting.create_voltage_trace(volt_df, experiment_start_time)
-
-                fig.add_trace(fig_nmr_heatmap['data'][0], row=1, col=1)
-                fig.add_trace(fig_voltage_trace['data'][0], row=1, col=2)
-                fig.add_trace(fig_voltage_trace['data'][1], row=1, col=2)
-                fig.data[-1].update(xaxis='x3')
-
-                fig.update_layout(
-                    height=800,
-                    width=1200,
-                )
+            # Create a subplot figure with 2 columns
+            fig = make_subplots(rows=1, cols=2, shared_yaxes=True, column_widths=[0.67, 0.33], horizontal_spacing=0.02)
 
-                # Add annotation in the bottom-right corner
-                fig.add_annotation(
-                    text="Akkuspin",  # Text to display
-                    font=dict(size=12, color="lightgrey"),  # Font size and color
-                    xref="paper",  # Reference the full figure width
-                    yref="paper",  # Reference the full figure height
-                    x=0.62,  # Bottom-right corner (95% of the width)
-                    y=0.01,  # Bottom edge (5% of the height)
-                    showarrow=False  # No arrow
-                )
+            print("Creating NMR Heatmap")
+            fig_nmr_heatmap = plotting.create_nmr_heatmap(heatmap_stack.ppm, heatmap_stack.times, heatmap_stack.data, experiment_start_time)
+            # Pass the start time to the voltage trace function
+            fig_voltage_trace = plotting.create_voltage_trace(volt_df, experiment_start_time)
 
-                fig.update_xaxes(
-                    range=[ppm_max, ppm_min],
-                    title_text="Chemical Shift (ppm)",
-                    title_font=dict(size=20, color="black"),
-                    tickfont=dict(size=18, color="black"),
-                    row=1,
-                    col=1
-                )
+            fig.add_trace(fig_nmr_heatmap['data'][0], row=1, col=1)
+            fig.add_trace(fig_voltage_trace['data'][0], row=1, col=2)
+            fig.add_trace(fig_voltage_trace['data'][1], row=1, col=2)
+            fig.data[-1].update(xaxis='x3')
 
-                fig.update_yaxes(
-                    title_text="Experiment Time (h)",
-                    title_font=dict(size=20, color="black"),
-                    tickfont=dict(size=18, color="black"),
-                    row=1,
-                    col=1
-                )
+            fig.update_layout(
+                height=800,
+                width=1200,
+            )
+
+            # Add annotation in the bottom-right corner
+            fig.add_annotation(
+                text="Akkuspin",  # Text to display
+                font=dict(size=12, color="lightgrey"),  # Font size and color
+                xref="paper",  # Reference the full figure width
+                yref="paper",  # Reference the full figure height
+                x=0.62,  # Bottom-right corner (95% of the width)
+                y=0.01,  # Bottom edge (5% of the height)
+                showarrow=False  # No arrow
+            )
+
+            fig.update_xaxes(
+                range=[ppm_max, ppm_min],
+                title_text="Chemical Shift (ppm)",
+                title_font=dict(size=20, color="black"),
+                tickfont=dict(size=18, color="black"),
+                row=1,
+                col=1
+            )
 
-                fig.update_xaxes(
-                    title_text="Voltage Profile (V)",
+            fig.update_yaxes(
+                title_text="Experiment Time (h)",
+                title_font=dict(size=20, color="black"),
+                tickfont=dict(size=18, color="black"),
+                row=1,
+                col=1
+            )
+
+            fig.update_xaxes(
+                title_text="Voltage Profile (V)",
+                showgrid=False,
+                gridcolor='lightpink',  # Set grid line color
+                gridwidth=1,  # Set grid line width
+                minor=dict(showgrid=False),  # Hide minor grid lines
+                title_font=dict(size=20, color="red"),
+                tickfont=dict(size=18, color="red"),
+                row=1,
+                col=2
+            )
+
+            fig.update_layout(
+                showlegend=False,
+                xaxis3=dict(
+                    overlaying='x2',  # same horizontal domain as the bottom axis
+                    side='top',  # label/ticks on top
+                    title='Q - Q₀ (mAh)',  # top axis label
                     showgrid=False,
-                    gridcolor='lightpink',  # Set grid line color
+                    gridcolor='lightblue',  # Set grid line color
                     gridwidth=1,  # Set grid line width
                     minor=dict(showgrid=False),  # Hide minor grid lines
-                    title_font=dict(size=20, color="red"),
-                    tickfont=dict(size=18, color="red"),
-                    row=1,
-                    col=2
-                )
-
-                fig.update_layout(
-                    showlegend=False,
-                    xaxis3=dict(
-                        overlaying='x2',  # same horizontal domain as the bottom axis
-                        side='top',  # label/ticks on top
-                        title='Q - Q₀ (mAh)',  # top axis label
-                        showgrid=False,
-                        gridcolor='lightblue',  # Set grid line color
-                        gridwidth=1,  # Set grid line width
-                        minor=dict(showgrid=False),  # Hide minor grid lines
-                        title_font = dict(size=20, color="blue"),  # Consistent font size and color
-                        tickfont = dict(size=18, color="blue")
-                    )
+                    title_font = dict(size=20, color="blue"),  # Consistent font size and color
+                    tickfont = dict(size=18, color="blue")
                 )
+            )
 
-                first_spectrum_path, last_spectrum_path = utils.find_first_last_spectra(nmr_folder, nucleus)
+            if spectra_handle['live'] and len(heatmap_stack) > decimation.HEATMAP_ROWS:
+                # Rows binned along time cannot be appended to, every tick sends the binary figure
+                live.drop_view(session_id)
+            elif spectra_handle['live']:
+                view.record(heatmap_stack, len(fig.data[0].x), [(trace.x, trace.y) for trace in fig.data[1:3]], volt_df)
+                # Plain lists instead of binary arrays, so the next ticks can extend the traces
+                figure = fig.to_dict()
+                for trace_dict, trace in zip(figure['data'], fig.data):
+                    for key in ('x', 'y', 'z'):
+                        if key in trace_dict:
+                            trace_dict[key] = np.asarray(trace[key]).tolist()
+                return figure, ""
+
+            return fig, ""
+
+        except stages.StageLost:
+            # The spectra were dropped from memory and the folder changed since, keep the figure that is shown
+            return dash.no_update, "The spectra changed since the last refresh, press Update to reload them."
+        except Exception as e:
+            print(f"Error in heatmap callback: {e}")
+            live.drop_view(session_id)
+            return go.Figure(), ""
 
-                spectra_fig = plotting.create_spectra_fig(first_spectrum_path, last_spectrum_path, format_type, nmr_start_time, nmr_end_time)
+    @app.callback(
+        Output('first_last_spectrum_plot', 'figure'),
+        Input('first_last_handle', 'data'),
+        prevent_initial_call=True
+    )
+    def update_first_last_plot(first_last_handle):
+        if not first_last_handle:
+            return go.Figure()
+        try:
+            return plotting.create_spectra_fig(stages.first_last(first_last_handle),
+                                               datetime.fromisoformat(first_last_handle['start']),
+                                               datetime.fromisoformat(first_last_handle['end']))
+        except Exception as e:
+            print(f"Error in first and last spectra callback: {e}")
+            return go.Figure()
 
-                fid_fig = plotting.create_3d_fid_plot(last_spectrum_path, format_type)
+    @app.callback(
+        Output('fid_plot', 'figure'),
+        Input('fid_handle', 'data'),
+        prevent_initial_call=True
+    )
+    def update_fid_plot(fid_handle):
+        if not fid_handle:
+            return go.Figure()
+        try:
+            return plotting.create_3d_fid_plot(fid_handle['path'], fid_handle['format_type'],
+                                               stages.fid(fid_handle))
+        except Exception as e:
+            print(f"Error in FID callback: {e}")
+            return go.Figure()
 
-                # Check if electrochemistry data directory is provided
-                if voltage_folder:
-                    try:
-                        # Generate electrochemical plot
-                        cycle_plot = plotting.plot_capacities_and_efficiency_eclab(voltage_folder)
-                    except Exception as e:
-                        print(f"Error processing data or generating battery cycling plot: {e}")
-                        cycle_plot = go.Figure()
-                else:
-                    cycle_plot = go.Figure()
+    @app.callback(
+        Output('cycle_plot', 'figure'),
+        Input('cycle_handle', 'data'),
+        prevent_initial_call=True
+    )
+    def update_cycle_plot(cycle_handle):
+        if not cycle_handle:
+            return go.Figure()
+        try:
+            # Generate electrochemical plot
+            return plotting.plot_capacities_and_efficiency_eclab(cycle_handle['voltage_folder'],
+                                                                 stages.eclab(cycle_handle))
+        except Exception as e:
+            print(f"Error processing data or generating battery cycling plot: {e}")
+            return go.Figure()
 
-                return fig, spectra_fig, fid_fig, cycle_plot, ""
-            else:
-                print("Callback triggered by an unexpected source.")
-                return go.Figure(), go.Figure(), go.Figure(), go.Figure(), ""
+    @app.callback(
+        Output('nmr_plot', 'figure', allow_duplicate=True),
+        Input('nmr_plot', 'relayoutData'),
+        [State('voltage_handle', 'data'),
+         State('session_id', 'data')],
+        prevent_initial_call=True
+    )
+    def zoom_voltage_trace(relayout_data, voltage_handle, session_id):
+        # The voltage traces share the time axis of the heatmap, a zoom of either re-decimates the zoomed range
+        hours_range = decimation.relayout_range(relayout_data, ('yaxis', 'yaxis2'))
+        if hours_range is False or not voltage_handle:
+            raise PreventUpdate
 
-        except Exception as e:
-            print(f"Error in heatmap callback: {e}")
-            return go.Figure(), go.Figure(), go.Figure(), go.Figure(), ""
+        ec_v_df = stages.eclab(voltage_handle)[1]
+        volt_df = data_processing.eclab_voltage(ec_v_df, datetime.fromisoformat(voltage_handle['start']),
+                                                datetime.fromisoformat(voltage_handle['end']))
+        (voltage, voltage_hours), (q, q_hours) = plotting.voltage_trace_points(
+            volt_df, datetime.fromisoformat(voltage_handle['experiment_start']), hours_range)
 
+        # Plain lists, live ticks extend these traces afterwards and must know which points are shown
+        view = live.current_view(session_id)
+        if view is not None:
+            view.record_traces([(voltage, voltage_hours), (q, q_hours)], volt_df)
 
+        patch = Patch()
+        patch['data'][1]['x'] = np.asarray(voltage).tolist()
+        patch['data'][1]['y'] = np.asarray(voltage_hours).tolist()
+        patch['data'][2]['x'] = np.asarray(q).tolist()
+        patch['data'][2]['y'] = np.asarray(q_hours).tolist()
+        return patch
 
-def register_integration_callback(app):
     @app.callback(
-        Output('int-plot', 'figure'),
-        [
-            Input('integrate-button', 'n_clicks')
-        ],
-        [
-            State('ppm-range-min', 'value'),
-            State('ppm-range-max', 'value'),
-            State('internal-ppm-range-min', 'value'),
-            State('internal-ppm-range-max', 'value'),
-            State('normalize-standard-to', 'value'),
-            State('voltage-filter-type', 'value'),
-            State('voltage-filter-value', 'value'),
-            State('nmr_folder_input', 'value'),
-            State('voltage_folder_input', 'value'),
-            State('data_int', 'value'),
-            State('int_start_datetime', 'value'),
-            State('int_end_datetime', 'value')
-        ]
+        Output('fid_plot', 'figure', allow_duplicate=True),
+        Input('fid_plot', 'relayoutData'),
+        State('fid_handle', 'data'),
+        prevent_initial_call=True
     )
-    def integrate_spectra(n_clicks, ppm_min, ppm_max, internal_ppm_min, internal_ppm_max, normalize_to,
-                          voltage_filter_type, voltage_filter_value, nmr_folder, voltage_folder,data_int,
-                          int_start_datetime, int_end_datetime):
-        if n_clicks is None:
+    def zoom_fid_plot(relayout_data, fid_handle):
+        time_range = decimation.relayout_range(relayout_data, ('xaxis',))
+        if time_range is False or not fid_handle or not fid_handle['path']:
             raise PreventUpdate
 
+        dic, data, sw, obs, car, label, runtime = stages.fid(fid_handle)
+        time_points, intensity = plotting.fid_trace_points(data, sw, time_range)
+
+        patch = Patch()
+        patch['data'][0]['x'] = time_points
+        patch['data'][0]['y'] = intensity
+        return patch
+
+
+
+def register_integration_callback(app):
+    def compute_integration(job, ppm_min, ppm_max, internal_ppm_min, internal_ppm_max, normalize_to,
+                            voltage_filter_type, voltage_filter_value, nmr_folder, voltage_folder, data_int,
+                            int_start_datetime, int_end_datetime):
+        """Integral plot, run in the job pool and reporting its stages to the progress bar."""
         # Check if inputs are valid
         if not all([ppm_min, ppm_max, internal_ppm_min, internal_ppm_max, normalize_to, voltage_filter_type, voltage_filter_value, nmr_folder, voltage_folder,data_int,
                           int_start_datetime, int_end_datetime]):
@@ -284,6 +540,7 @@ def register_integration_callback(app):
             ("internal_standard", internal_ppm_min, internal_ppm_max)
         ]
 
+        job.progress('Reading voltage data', 0)
         # Load voltage data
         eclab_df = data_processing.process_eclab(voltage_folder)
         ec_v_df = eclab_df[1]
@@ -295,13 +552,9 @@ def register_integration_callback(app):
         else:
             filtered_voltages = ec_v_df[ec_v_df['Voltage'] < voltage_filter_value]
 
-        valid_times = filtered_voltages['Timestamp']
-
+        job.progress('Matching spectra', 10)
         # Load and process NMR spectra
-        spectra_paths = sorted(data_processing.find_spectra_in_range(nmr_folder, datetime.min, datetime.max, '19F'))  # Adjust the nucleus parameter as needed
-        integrated_values = []
-        times = []
-
+        spectra_paths = data_processing.find_spectra_in_range(nmr_folder, datetime.min, datetime.max, '19F')  # Adjust the nucleus parameter as needed
 
         # Convert NMR spectrum times to pandas datetime for easier matching
         nmr_times = pd.Series([data_processing.extract_date_time(path) for path in spectra_paths])
@@ -317,40 +570,26 @@ def register_integration_callback(app):
         # Filter voltage data based on the common time range
         filtered_voltages = filtered_voltages[(filtered_voltages['Timestamp'] >= nmr_start_time) & (filtered_voltages['Timestamp'] <= nmr_end_time)]
 
-        def round_to_nearest_minute(timestamp):
-            return timestamp.replace(second=0, microsecond=0)
-
-        valid_times = filtered_voltages['Timestamp']
-        valid_times_rounded = [round_to_nearest_minute(time) for time in valid_times]
-        valid_times_filtered = []
-        for time in valid_times_rounded:
-            if time not in valid_times_filtered:
-                valid_times_filtered.append(time)
-        valid_times = valid_times_filtered
-
-        # Initialize progress bar
-        progress_bar = tqdm(total=len(valid_times), desc="Integration Progress")
-
-        for voltage_time in valid_times:
-            # Find the closest NMR time
-            closest_nmr_time = nmr_times.iloc[(nmr_times - voltage_time).abs().argsort()[:1]].values[0]
-            spectrum_path = spectra_paths[nmr_times[nmr_times == closest_nmr_time].index[0]]
-            results = data_processing.integrate_spectrum(spectrum_path, integration_limits)
-            internal_standard_area = None
-            integrated_area = None
-            for name, start, stop, area in results:
-                if name == "internal_standard":
-                    internal_standard_area = area
-                else:
-                    integrated_area = area
-                # Calculate normalized value if both areas are obtained
-            normalized_value = integrated_area#/internal_standard_area
-            integrated_values.append(normalized_value)
-            times.append(closest_nmr_time)
-            progress_bar.update(1)
-        progress_bar.close()
-        # Convert numpy datetime64 objects to Python datetime objects
-        times = [ts.astype('M8[ms]').astype('O') for ts in times]
+        # Every spectrum closest in time to a voltage sample that passed the filter, each integrated once
+        spectrum_indices = data_processing.match_spectra_to_times(filtered_voltages['Timestamp'], nmr_times)
+        matched_paths = [spectra_paths[index] for index in spectrum_indices]
+        region_ppms = [float(ppm) for name, start, end in integration_limits for ppm in (start, end)]
+        roi = data_processing.roi_bounds(min(region_ppms), max(region_ppms))
+        # |spectrum| does not depend on the phase, the series phase reuses the spectra cached for the heatmap
+        p0, p1 = phasing.series_phase(nmr_folder, '19F', 'Varian', spectra_paths)
+
+        def build_stack():
+            results = data_processing.process_spectra(matched_paths, 'Varian', apply_autophase=False, p0=p0, p1=p1,
+                                                      roi=roi, progress=job.steps('Processing spectra', 15, 90))
+            return spectral_stack.SpectralStack.from_results(matched_paths, results, dtype=np.complex64)
+
+        # All matched spectra in one complex stack, kept with its integral table so other regions are lookups
+        stack = stages.fetch(stages.stage_handle('integration', matched_paths, 'Varian', (p0, p1), roi), build_stack)
+        job.progress('Integrating', 90)
+        areas = {name: integral for name, start, stop, integral in stack.integrate(integration_limits)}
+        internal_standard_area = areas["internal_standard"]
+        integrated_values = list(areas["anolyte"])  # normalized: / internal_standard_area
+        times = list(stack.times)
 
         # Create the plot
         fig = go.Figure()
@@ -376,4 +615,39 @@ def register_integration_callback(app):
         print(times)
         print("------------------------------------------")
 
-        return fig
\ No newline at end of file
+        return fig
+
+    @app.callback(
+        [Output('integration_job', 'data'),
+         Output('job_poll', 'disabled', allow_duplicate=True)],
+        [
+            Input('integrate-button', 'n_clicks')
+        ],
+        [
+            State('ppm-range-min', 'value'),
+            State('ppm-range-max', 'value'),
+            State('internal-ppm-range-min', 'value'),
+            State('internal-ppm-range-max', 'value'),
+            State('normalize-standard-to', 'value'),
+            State('voltage-filter-type', 'value'),
+            State('voltage-filter-value', 'value'),
+            State('nmr_folder_input', 'value'),
+            State('voltage_folder_input', 'value'),
+            State('data_int', 'value'),
+            State('int_start_datetime', 'value'),
+            State('int_end_datetime', 'value'),
+            State('session_id', 'data')
+        ],
+        prevent_initial_call=True
+    )
+    def integrate_spectra(n_clicks, ppm_min, ppm_max, internal_ppm_min, internal_ppm_max, normalize_to,
+                          voltage_filter_type, voltage_filter_value, nmr_folder, voltage_folder, data_int,
+                          int_start_datetime, int_end_datetime, session_id):
+        if n_clicks is None:
+            raise PreventUpdate
+
+        # Integration runs in the job pool, an integration with other inputs replaces the running one of this session
+        inputs = (ppm_min, ppm_max, internal_ppm_min, internal_ppm_max, normalize_to, voltage_filter_type,
+                  voltage_filter_value, nmr_folder, voltage_folder, data_int, int_start_datetime, int_end_datetime)
+        job = jobs.submit((session_id, 'integration'), inputs, compute_integration, *inputs)
+        return job.id, False
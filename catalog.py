@@ -0,0 +1,139 @@
+import bisect
+import datetime
+import os
+import threading
+
+
+def parse_spectrum_name(dir_name):
+    """Split a spectrum directory name like 19F_20231118T023054.fid into nucleus and timestamp."""
+    try:
+        nucleus, date_time_str = dir_name.split('_')[:2]
+        return nucleus, datetime.datetime.strptime(date_time_str.split('.')[0], "%Y%m%dT%H%M%S")
+    except ValueError:
+        return None, None
+
+
+class SpectrumCatalog:
+    """Timestamped .fid directories below an NMR folder, sorted by time and partitioned by nucleus.
+
+    Directory listings are kept together with the directory modification time, so a refresh only
+    lists directories whose contents changed since the previous one.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._listings = {}
+        # (times, paths) per nucleus, replaced as a whole so readers never need the lock
+        self._index = ({}, {})
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Pick up added or removed spectra, returns True when the catalog changed."""
+        with self._lock:
+            changed = False
+            listings = {}
+            pending = [self.folder]
+            while pending:
+                directory = pending.pop()
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    changed = True
+                    continue
+                listing = self._listings.get(directory)
+                if listing is None or listing[0] != mtime:
+                    listing = (mtime,) + self._list_directory(directory)
+                    changed = True
+                listings[directory] = listing
+                pending.extend(listing[2])
+            if listings.keys() != self._listings.keys():
+                changed = True
+            self._listings = listings
+            if changed:
+                self._rebuild()
+            return changed
+
+    @staticmethod
+    def _list_directory(directory):
+        spectra = []
+        subdirs = []
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return spectra, subdirs
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            if entry.name.endswith(".fid"):
+                nucleus, file_date_time = parse_spectrum_name(entry.name)
+                if file_date_time is not None:
+                    spectra.append((nucleus, file_date_time, entry.path))
+            else:
+                subdirs.append(entry.path)
+        return spectra, subdirs
+
+    def _rebuild(self):
+        partitions = {}
+        for mtime, spectra, subdirs in self._listings.values():
+            for nucleus, file_date_time, path in spectra:
+                partitions.setdefault(nucleus, []).append((file_date_time, path))
+        times = {}
+        paths = {}
+        for nucleus, entries in partitions.items():
+            entries.sort()
+            times[nucleus] = [file_date_time for file_date_time, path in entries]
+            paths[nucleus] = [path for file_date_time, path in entries]
+        self._index = (times, paths)
+
+    def __len__(self):
+        times, paths = self._index
+        return sum(len(nucleus_paths) for nucleus_paths in paths.values())
+
+    def directories(self):
+        """Directories below the NMR folder that are searched for spectra, the folder itself included."""
+        return list(self._listings)
+
+    def newest(self):
+        """Path of the newest spectrum of any nucleus, None for an empty folder."""
+        times, paths = self._index
+        entries = [(times[n][-1], paths[n][-1]) for n in times if times[n]]
+        return max(entries)[1] if entries else None
+
+    def spectra_in_range(self, start_date, end_date, nucleus):
+        """Paths of the spectra with start_date <= timestamp <= end_date, in time order."""
+        times, paths = self._index
+        nucleus_times = times.get(nucleus, [])
+        lo = bisect.bisect_left(nucleus_times, start_date)
+        hi = bisect.bisect_right(nucleus_times, end_date)
+        return paths[nucleus][lo:hi] if hi > lo else []
+
+    def first_last(self, nucleus):
+        paths = self._index[1].get(nucleus)
+        if not paths:
+            return None, None
+        return paths[0], paths[-1]
+
+    def earliest(self, nucleus=None):
+        times = self._index[0]
+        firsts = [times[n][0] for n in ([nucleus] if nucleus else times) if times.get(n)]
+        return min(firsts) if firsts else None
+
+    def latest(self, nucleus=None):
+        times = self._index[0]
+        lasts = [times[n][-1] for n in ([nucleus] if nucleus else times) if times.get(n)]
+        return max(lasts) if lasts else None
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(folder):
+    """Return the refreshed catalog of an NMR folder, built on first use and updated incrementally after."""
+    folder = os.path.normpath(folder)
+    with _catalogs_lock:
+        spectrum_catalog = _catalogs.get(folder)
+        if spectrum_catalog is None:
+            spectrum_catalog = _catalogs[folder] = SpectrumCatalog(folder)
+    spectrum_catalog.refresh()
+    return spectrum_catalog
@@ -2,13 +2,19 @@ import datetime
 import nmrglue as ng
 import os
 import utils
+import catalog
 from galvani_mod import BioLogic
-from datetime import timedelta
 import pandas as pd
-import shelve
-import hashlib
-import os
+import json
 import numpy as np
+import functools
+import multiprocessing
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tqdm import tqdm
 
 
 
@@ -23,16 +29,8 @@ def extract_date_time(file_path):
 
 
 def find_spectra_in_range(directory, start_date, end_date, nucleus):
-    spectra_paths = []
-    for root, dirs, files in os.walk(directory):
-        for dir_name in dirs:
-            if dir_name.endswith(".fid"):
-                file_path = os.path.join(root, dir_name)
-                file_date_time = extract_date_time(file_path)
-                if (file_date_time and start_date <= file_date_time <= end_date and
-                        file_path.split(os.sep)[-1].startswith(nucleus)):
-                    spectra_paths.append(file_path)
-    return spectra_paths
+    # Spectra are returned in time order
+    return catalog.get_catalog(directory).spectra_in_range(start_date, end_date, nucleus)
 
 def read_nmr_data_lowmem(base_dir, format_type):
     if format_type == 'Varian':
@@ -44,82 +42,503 @@ def read_nmr_data_lowmem(base_dir, format_type):
 
 def read_varian_lowmem(base_dir):
     """Read Varian data as low-memory objects."""
-    dic, data = ng.varian.read(base_dir)
-    procpar = ng.varian.read_procpar(base_dir + "/procpar")
-    sw = float(procpar['sw']['values'][0])
-    obs = float(procpar['sfrq']['values'][0])
-    rfl = float(procpar['rfl']['values'][0])
+    procpar = read_procpar_values(os.path.join(base_dir, 'procpar'))
+    data = read_varian_fid(os.path.join(base_dir, 'fid'))
+    sw = procpar['sw']
+    obs = procpar['sfrq']
+    rfl = procpar['rfl']
     car = (sw / 2)-rfl
-    label = procpar['tn']['values'][0]
-    runtime_str = procpar['time_run']['values'][0]
-    runtime = datetime.datetime.strptime(runtime_str, "%Y%m%dT%H%M%S")
+    label = procpar['tn']
+    runtime = datetime.datetime.strptime(procpar['time_run'], "%Y%m%dT%H%M%S")
+    # The pipe conversion takes every parameter from udic, so the dictionary only records what was read
+    dic = {'procpar': procpar, 'np': data.shape[-1] * 2}
     return dic, data, sw, obs, car, label, runtime
 
+
+# Varian fid files start with a 32 byte file header, every block has nbheaders 28 byte block headers in front
+# of its traces. Everything is big-endian.
+VARIAN_FILE_HEADER = np.dtype([('nblocks', '>i4'), ('ntraces', '>i4'), ('np', '>i4'), ('ebytes', '>i4'),
+                               ('tbytes', '>i4'), ('bbytes', '>i4'), ('vers_id', '>i2'), ('status', '>i2'),
+                               ('nbheaders', '>i4')])
+VARIAN_BLOCK_HEADER_SIZE = 28
+
+# The only procpar parameters read_varian_lowmem needs
+VARIAN_PROCPAR_KEYS = ('sw', 'sfrq', 'rfl', 'tn', 'time_run')
+
+
+def read_varian_fid(fid_path):
+    """Memory-map a Varian fid file and return its traces as complex64, 1D for a single trace like nmrglue."""
+    header = np.fromfile(fid_path, dtype=VARIAN_FILE_HEADER, count=1)
+    if header.size == 0:
+        raise ValueError(f"{fid_path} is too short for a Varian file header")
+    header = header[0]
+    status = int(header['status'])
+    if status & 0x8:
+        value_type = np.dtype('>f4')
+    elif status & 0x4:
+        value_type = np.dtype('>i4')
+    else:
+        value_type = np.dtype('>i2')
+    if int(header['ebytes']) != value_type.itemsize:
+        raise ValueError(f"{fid_path}: {int(header['ebytes'])} bytes per point does not match status {status:#x}")
+
+    ntraces, n_values = int(header['ntraces']), int(header['np'])
+    block_type = np.dtype([('header', 'V', int(header['nbheaders']) * VARIAN_BLOCK_HEADER_SIZE),
+                           ('traces', value_type, (ntraces, n_values))])
+    blocks = np.memmap(fid_path, dtype=block_type, mode='r', offset=VARIAN_FILE_HEADER.itemsize,
+                       shape=(int(header['nblocks']),))
+    raw = blocks['traces'].reshape(-1, n_values)
+
+    # Points are stored as interleaved real and imaginary values
+    data = np.empty((raw.shape[0], n_values // 2), dtype=np.complex64)
+    data.real = raw[:, 0::2]
+    data.imag = raw[:, 1::2]
+    return data[0] if data.shape[0] == 1 else data
+
+
+def read_procpar_values(procpar_path, keys=VARIAN_PROCPAR_KEYS):
+    """First value of each of keys in a Varian procpar file, the scan stops as soon as all keys were found.
+
+    Every parameter is a line starting with its name and basic type (1 real, 2 string), followed by a line
+    with the number of values and the values themselves. Strings are returned without quotes, reals as floats.
+    """
+    wanted = set(keys)
+    values = {}
+    with open(procpar_path, 'r', encoding='latin1') as file:
+        for line in file:
+            name = line.split(' ', 1)[0]
+            if name not in wanted:
+                continue
+            basic_type = line.split()[2]
+            value = next(file).split(None, 1)[1].strip()
+            values[name] = value.strip('"') if basic_type == '2' else float(value.split()[0])
+            wanted.discard(name)
+            if not wanted:
+                break
+    if wanted:
+        raise KeyError(f"{procpar_path} is missing {', '.join(sorted(wanted))}")
+    return values
+
+
 def read_bruker_lowmem(base_dir):
     """Read Bruker data as low-memory objects."""
     return dic, data, sw, obs, car, label, runtime
 
 
-def process_nmr_data(path, nmr_format, apply_autophase=True, p0=0.0, p1=0.0):
-    """Process NMR data with optional autophasing, adaptable to different NMR formats."""
+# On-disk cache of processed spectra: <uid>.npy holds the spectrum, <uid>.json its SpectrumMeta.
+# Bump CACHE_VERSION whenever the processing pipeline or the cache format changes.
+CACHE_DIR = 'cache_dir'
+CACHE_VERSION = 2
+
+
+@functools.lru_cache(maxsize=64)
+def ppm_axis(size, sw, obs, car):
+    """ppm scale of a spectrum, shared read-only by every spectrum with the same axis parameters."""
+    ppm_scale = ng.fileiobase.unit_conversion(size, False, sw, obs, car).ppm_scale()
+    ppm_scale.setflags(write=False)
+    return ppm_scale
+
+
+class SpectrumMeta:
+    """Parameters of one processed spectrum, in place of its NMRPipe dictionary.
+
+    sw (Hz), obs (MHz), car (Hz) and size describe the frequency axis of the processed points, recipe is a hash
+    of the processing recipe that produced them.
+    """
+    __slots__ = ('runtime', 'nucleus', 'sw', 'obs', 'car', 'size', 'p0', 'p1', 'recipe')
+
+    def __init__(self, runtime, nucleus, sw, obs, car, size, p0, p1, recipe):
+        self.runtime = runtime
+        self.nucleus = nucleus
+        self.sw = float(sw)
+        self.obs = float(obs)
+        self.car = float(car)
+        self.size = int(size)
+        self.p0 = float(p0)
+        self.p1 = float(p1)
+        self.recipe = recipe
+
+    @classmethod
+    def from_pipe(cls, dic, data, runtime, nucleus, p0, p1, recipe):
+        """Metadata of processed 1D pipe data, the axis is taken from dic the same way as ng.pipe.make_uc."""
+        fn = "FDF" + str(int(dic["FDDIMORDER"][0]))
+        size = data.shape[-1]
+        sw = dic[fn + "SW"] or 1.0
+        obs = dic[fn + "OBS"] or 1.0
+        car = dic[fn + "ORIG"] + sw / 2. - sw / size
+        return cls(runtime, nucleus, sw, obs, car, size, p0, p1, recipe_hash(recipe))
+
+    @classmethod
+    def from_dict(cls, values):
+        values = dict(values)
+        values['runtime'] = datetime.datetime.fromisoformat(values['runtime'])
+        return cls(**values)
+
+    def to_dict(self):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values['runtime'] = self.runtime.isoformat()
+        return values
+
+    def ppm_scale(self):
+        return ppm_axis(self.size, self.sw, self.obs, self.car)
+
+    def roi(self, columns, recipe):
+        """Metadata of the points data[columns], a contiguous slice of this spectrum."""
+        size = columns.stop - columns.start
+        hz_per_point = self.sw / self.size
+        # Hz of the first kept point, the axis runs from car + sw / 2 downwards
+        first = self.car + self.sw / 2. - columns.start * hz_per_point
+        sw = hz_per_point * size
+        return SpectrumMeta(self.runtime, self.nucleus, sw, self.obs, first - sw / 2., size, self.p0, self.p1,
+                            recipe_hash(recipe))
+
+
+def recipe_hash(recipe):
+    return hashlib.sha256(recipe.encode()).hexdigest()[:16]
+
+
+def processing_recipe(apply_autophase, p0, p1, lb):
+    """Describe every processing step that affects the spectrum, used as part of the cache key."""
+    phase = 'acme' if apply_autophase else f"ps:{float(p0)!r}:{float(p1)!r}"
+    return f"v{CACHE_VERSION};em:{float(lb)!r};zf:auto;ft:auto;{phase}"
+
+
+def spectrum_cache_paths(path, nmr_format, recipe):
+    spectra_dir = os.path.join(CACHE_DIR, 'spectra')
+    uid = utils.generate_uid(path, nmr_format, utils.spectrum_fingerprint(path), recipe)
+    return os.path.join(spectra_dir, uid + '.npy'), os.path.join(spectra_dir, uid + '.json')
+
+
+def load_cached_spectrum(data_path, meta_path):
+    """Return the cached (meta, data) entry, with the spectrum memory-mapped rather than read into memory."""
+    try:
+        with open(meta_path, 'r') as file:
+            meta = SpectrumMeta.from_dict(json.load(file))
+        data = np.load(data_path, mmap_mode='r')
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+    return meta, data
 
-    # Ensure the cache directory exists
-    cache_dir = 'cache_dir'
-    os.makedirs(cache_dir, exist_ok=True)
-    cache_path = os.path.join(cache_dir, 'nmr_data_cache.db')
 
-    uid = utils.generate_uid(path, nmr_format)
+def replace_file(path, write, mode='wb'):
+    """Write a file through a temporary file of its own, so readers never see a partly written file.
 
-    with shelve.open(cache_path) as cache:
-        if uid in cache:
-            #print(f"Retrieving cached data for UID: {uid}")
-            dic, data, p0, p1, runtime, obs, sw, car = cache[uid]
-            #print(dic)
-        else:
-            #print(f"Processing and caching data for UID: {uid}")
+    Every writer gets a unique temporary name, threads and processes writing the same entry do not collide.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as file:
+            write(file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
-            dic, data, sw, obs, car, label, runtime = read_nmr_data_lowmem(path, nmr_format)
 
-            # Your existing processing logic here
-            if nmr_format == 'Varian':
-                udic = ng.varian.guess_udic(dic, data)
-            elif nmr_format == 'Bruker':
-                udic = ng.bruker.guess_udic(dic, data)
-            else:
-                raise ValueError(f"Unsupported NMR format: {nmr_format}")
-
-            udic[0]['size'] = data.shape[0]
-            udic[0]['complex'] = True
-            udic[0]['encoding'] = 'direct'
-            udic[0]['sw'] = sw
-            udic[0]['obs'] = obs
-            udic[0]['car'] = car
-            udic[0]['runtime'] = runtime
-
-            C = ng.convert.converter()
-            if nmr_format == 'Varian':
-                C.from_varian(dic, data, udic)
-            elif nmr_format == 'Bruker':
-                C.from_bruker(dic, data, udic)
-
-            dic, data = C.to_pipe()
-            dic, data = ng.pipe_proc.em(dic, data, lb=2)
-            dic, data = ng.pipe_proc.zf(dic, data, auto=True)
-            dic, data = ng.pipe_proc.ft(dic, data, auto=True)
-
-            if apply_autophase:
-                data, phase_params = ng.proc_autophase.autops(data, 'acme', return_phases=True)
-                p0, p1 = phase_params
-                print("Phasing parameters:")
-                print(p0)
-                print(p1)
-            else:
-                dic, data = ng.process.pipe_proc.ps(dic, data, p0=p0, p1=p1)
+def save_array(array_path, array):
+    """Save an array as .npy through a temporary file, so readers never see a partly written file."""
+    replace_file(array_path, lambda file: np.save(file, np.ascontiguousarray(array)))
+
+
+def store_cached_spectrum(data_path, meta_path, meta, data):
+    """Write an entry atomically, the metadata file is written last and marks the entry as complete."""
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    save_array(data_path, data)
+    replace_file(meta_path, lambda file: json.dump(meta.to_dict(), file), mode='w')
+
+
+# A region of interest is the requested ppm window widened by ROI_MARGIN ppm on both sides and snapped outwards
+# to multiples of ROI_STEP ppm, so zooming within the same region reuses the cached ROI spectra
+ROI_MARGIN = 2.0
+ROI_STEP = 5.0
+
+
+def roi_bounds(ppm_min, ppm_max):
+    """ppm window (low, high) kept when ppm_min..ppm_max is requested."""
+    low = np.floor((float(ppm_min) - ROI_MARGIN) / ROI_STEP) * ROI_STEP
+    high = np.ceil((float(ppm_max) + ROI_MARGIN) / ROI_STEP) * ROI_STEP
+    return float(low), float(high)
+
 
-            # Cache the processed data
-            #cache[uid] = (dic, data, p0, p1, runtime, obs, sw, car)
+def ppm_window_slice(ppm_scale, ppm_min, ppm_max):
+    """Slice of the points with ppm_min <= ppm <= ppm_max, for an ascending or descending ppm scale."""
+    n = len(ppm_scale)
+    if n > 1 and ppm_scale[0] > ppm_scale[-1]:
+        ascending = ppm_scale[::-1]
+        return slice(n - int(np.searchsorted(ascending, ppm_max, side='right')),
+                     n - int(np.searchsorted(ascending, ppm_min, side='left')))
+    return slice(int(np.searchsorted(ppm_scale, ppm_min, side='left')),
+                 int(np.searchsorted(ppm_scale, ppm_max, side='right')))
+
+
+def roi_recipe(recipe, roi):
+    """Recipe of the ppm window roi of spectra processed with recipe, the windows are cached on their own."""
+    return f"{recipe};roi:{float(roi[0])!r}:{float(roi[1])!r}"
+
+
+def extract_roi(meta, data, roi, recipe):
+    """Cut a processed spectrum to the ppm window roi, returns the metadata and points of the cut."""
+    columns = ppm_window_slice(meta.ppm_scale(), *roi)
+    start = min(columns.start, data.shape[-1] - 1)
+    columns = slice(start, max(columns.stop, start + 1))
+    return meta.roi(columns, recipe), np.ascontiguousarray(data[..., columns])
+
+
+def store_roi(path, nmr_format, meta, data, roi, recipe):
+    """Cut a processed spectrum to roi, cache the cut under recipe and return its (meta, data)."""
+    roi_meta, roi_data = extract_roi(meta, data, roi, recipe)
+    store_cached_spectrum(*spectrum_cache_paths(path, nmr_format, recipe), roi_meta, roi_data)
+    return roi_meta, roi_data
+
+
+def convert_to_pipe(dic, data, sw, obs, car, runtime, nmr_format):
+    """Convert raw spectrometer data to NMRPipe format with nmrglue's converter."""
+    if nmr_format == 'Varian':
+        udic = ng.varian.guess_udic(dic, data)
+    elif nmr_format == 'Bruker':
+        udic = ng.bruker.guess_udic(dic, data)
+    else:
+        raise ValueError(f"Unsupported NMR format: {nmr_format}")
+
+    udic[0]['size'] = data.shape[0]
+    udic[0]['complex'] = True
+    udic[0]['encoding'] = 'direct'
+    udic[0]['sw'] = sw
+    udic[0]['obs'] = obs
+    udic[0]['car'] = car
+    udic[0]['runtime'] = runtime
+
+    C = ng.convert.converter()
+    if nmr_format == 'Varian':
+        C.from_varian(dic, data, udic)
+    elif nmr_format == 'Bruker':
+        C.from_bruker(dic, data, udic)
+
+    return C.to_pipe()
+
+
+def process_nmr_data(path, nmr_format, apply_autophase=True, p0=0.0, p1=0.0, lb=2.0):
+    """Process NMR data with optional autophasing, adaptable to different NMR formats. Returns (SpectrumMeta, spectrum)."""
+
+    recipe = processing_recipe(apply_autophase, p0, p1, lb)
+    data_path, meta_path = spectrum_cache_paths(path, nmr_format, recipe)
+
+    cached = load_cached_spectrum(data_path, meta_path)
+    if cached is not None:
+        return cached
+
+    dic, data, sw, obs, car, label, runtime = read_nmr_data_lowmem(path, nmr_format)
+
+    dic, data = convert_to_pipe(dic, data, sw, obs, car, runtime, nmr_format)
+    dic, data = ng.pipe_proc.em(dic, data, lb=lb)
+    dic, data = ng.pipe_proc.zf(dic, data, auto=True)
+    dic, data = ng.pipe_proc.ft(dic, data, auto=True)
+
+    if apply_autophase:
+        data, phase_params = ng.proc_autophase.autops(data, 'acme', return_phases=True)
+        p0, p1 = phase_params
+        print("Phasing parameters:")
+        print(p0)
+        print(p1)
+    else:
+        dic, data = ng.process.pipe_proc.ps(dic, data, p0=p0, p1=p1)
+
+    meta = SpectrumMeta.from_pipe(dic, data, runtime, label, p0, p1, recipe)
+    store_cached_spectrum(data_path, meta_path, meta, data)
+
+    return meta, data
+
+
+def process_fid_stack(fids, sw, nmr_format, apply_autophase=False, p0=0.0, p1=0.0, lb=2.0, block_size=64):
+    """Apodize, zero fill, Fourier transform and phase a 2D stack of FIDs along the last axis.
+
+    Reproduces ng.pipe_proc em(lb), zf(auto=True), ft(auto=True) and ps on converted data, with each step
+    applied to a block of rows at once. Returns the spectra and the (p0, p1) used for every row.
+    """
+    n_fids, n_points = fids.shape
+    size = int(2 ** np.ceil(np.log2(2 * n_points)))
+    apod = np.exp(-np.pi * np.arange(n_points) * (lb / sw)).astype(np.complex64)
+    phase = np.exp(1.0j * np.deg2rad(p0 + p1 * np.arange(size) / size)).astype(np.complex64)
+
+    spectra = np.empty((n_fids, size), dtype=np.complex64)
+    for start in range(0, n_fids, block_size):
+        rows = slice(start, min(start + block_size, n_fids))
+        block = np.zeros((rows.stop - rows.start, size), dtype=np.complex64)
+        block[:, :n_points] = fids[rows] * apod
+        if nmr_format == 'Varian':
+            # ng.convert conjugates Varian data on its way to NMRPipe format
+            np.conjugate(block, out=block)
+        block = np.fft.fftshift(np.fft.ifft(block, axis=-1), axes=-1) * np.float32(size)
+        if not apply_autophase:
+            block *= phase
+        spectra[rows] = block
+
+    if apply_autophase:
+        phases = []
+        for index in range(n_fids):
+            spectra[index], phase_params = ng.proc_autophase.autops(spectra[index], 'acme', return_phases=True,
+                                                                         disp=False)
+            phases.append(tuple(phase_params))
+    else:
+        phases = [(p0, p1)] * n_fids
+    return spectra, phases
+
+
+# (sw, obs, car, size) of the processed axis per nmr format and acquisition setup, see spectrum_axis
+_axes = {}
+
+
+def spectrum_axis(dic, data, sw, obs, car, runtime, label, nmr_format):
+    """(sw, obs, car, size) of the processed spectra of an acquisition setup.
+
+    The axis only depends on the setup, so the pipe conversion, zero fill and Fourier transform are run on one
+    FID the first time a setup is seen and the axis is reused for every later FID with the same setup.
+    """
+    key = (nmr_format, label, data.shape[-1], sw, obs, car)
+    axis = _axes.get(key)
+    if axis is None:
+        pipe_dic, pipe_data = convert_to_pipe(dic, data, sw, obs, car, runtime, nmr_format)
+        pipe_dic, pipe_data = ng.pipe_proc.zf(pipe_dic, pipe_data, auto=True)
+        pipe_dic, pipe_data = ng.pipe_proc.ft(pipe_dic, pipe_data, auto=True)
+        meta = SpectrumMeta.from_pipe(pipe_dic, pipe_data, runtime, label, 0.0, 0.0, '')
+        axis = _axes[key] = (meta.sw, meta.obs, meta.car, meta.size)
+    return axis
+
+
+def process_spectrum_batch(paths, nmr_format, apply_autophase=False, p0=0.0, p1=0.0, lb=2.0, roi=None):
+    """Process spectra as 2D stacks, one stack per nucleus and acquisition setup, and cache every row.
+
+    With roi=(low, high) every row is also cut to that ppm window and only the windows are returned, so a worker
+    process only sends the windows back.
+    """
+    recipe = processing_recipe(apply_autophase, p0, p1, lb)
+    groups = {}
+    for index, path in enumerate(paths):
+        dic, data, sw, obs, car, label, runtime = read_nmr_data_lowmem(path, nmr_format)
+        key = (label, data.shape[-1], sw, obs, car)
+        groups.setdefault(key, []).append((index, path, dic, data, runtime))
+
+    results = [None] * len(paths)
+    for (label, n_points, sw, obs, car), members in groups.items():
+        fids = np.empty((len(members), n_points), dtype=np.complex64)
+        for row, (index, path, dic, data, runtime) in enumerate(members):
+            fids[row] = data
+
+        index, path, dic, data, runtime = members[0]
+        axis_sw, axis_obs, axis_car, axis_size = spectrum_axis(dic, data, sw, obs, car, runtime, label, nmr_format)
+        recipe_id = recipe_hash(recipe)
+
+        spectra, phases = process_fid_stack(fids, sw, nmr_format, apply_autophase, p0, p1, lb)
+        for (index, path, dic, data, runtime), spectrum, (sp0, sp1) in zip(members, spectra, phases):
+            meta = SpectrumMeta(runtime, label, axis_sw, axis_obs, axis_car, axis_size, sp0, sp1, recipe_id)
+            data_path, meta_path = spectrum_cache_paths(path, nmr_format, recipe)
+            store_cached_spectrum(data_path, meta_path, meta, spectrum)
+            if roi is not None:
+                results[index] = store_roi(path, nmr_format, meta, spectrum, roi, roi_recipe(recipe, roi))
+            else:
+                results[index] = (meta, spectrum)
+    return results
 
-    return dic, data, p0, p1, runtime, obs, sw, car
+# Number of worker processes used by process_spectra, 1 processes everything serially in the server process
+MAX_WORKERS = os.cpu_count() or 1
+# Largest number of FIDs stacked into one 2D array, bounds the memory used per worker
+BATCH_SIZE = 128
+
+_executor = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(max_workers):
+    """Return the shared process pool, created on first use so workers are only started once."""
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != max_workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False, cancel_futures=True)
+            # Spawned, not forked: the server is multi-threaded and a forked worker could inherit a held lock
+            _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+            _executor_workers = max_workers
+        return _executor
+
+
+def discard_executor(executor):
+    """Shut down a broken pool, the next get_executor starts a new one unless another job already did."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def process_spectra(paths, nmr_format, apply_autophase=False, p0=0.0, p1=0.0, lb=2.0, max_workers=None, roi=None,
+                    progress=None):
+    """Process a list of spectra, results are returned in the order of paths.
+
+    Cached spectra are loaded directly, the rest are split into batches that are processed as 2D stacks
+    across the process pool. With roi=(low, high) only that ppm window of every spectrum is returned, the
+    windows are cached separately from the full spectra. progress(done, total) is called after every batch.
+    """
+    if max_workers is None:
+        max_workers = MAX_WORKERS
+
+    recipe = processing_recipe(apply_autophase, p0, p1, lb)
+    if roi is None:
+        results = [load_cached_spectrum(*spectrum_cache_paths(path, nmr_format, recipe)) for path in paths]
+        missing = [index for index, result in enumerate(results) if result is None]
+    else:
+        window_recipe = roi_recipe(recipe, roi)
+        results = [load_cached_spectrum(*spectrum_cache_paths(path, nmr_format, window_recipe)) for path in paths]
+        missing = []
+        for index, result in enumerate(results):
+            if result is not None:
+                continue
+            # A cached full spectrum is memory-mapped, cutting it only reads the window
+            full = load_cached_spectrum(*spectrum_cache_paths(paths[index], nmr_format, recipe))
+            if full is not None:
+                results[index] = store_roi(paths[index], nmr_format, *full, roi, window_recipe)
+            else:
+                missing.append(index)
+    if not missing:
+        return results
+
+    n_batches = max(max_workers, -(-len(missing) // BATCH_SIZE))
+    batches = [missing[i::n_batches] for i in range(n_batches)]
+    batches = [sorted(batch) for batch in batches if batch]
+    worker = functools.partial(process_spectrum_batch, nmr_format=nmr_format, apply_autophase=apply_autophase,
+                               p0=p0, p1=p1, lb=lb, roi=roi)
+    batch_paths = [[paths[index] for index in batch] for batch in batches]
+
+    processed = None
+    if max_workers > 1 and len(batches) > 1:
+        executor = None
+        try:
+            executor = get_executor(max_workers)
+            processed = []
+            for batch_results in tqdm(executor.map(worker, batch_paths), total=len(batches), desc="Processing Spectra"):
+                processed.append(batch_results)
+                if progress is not None:
+                    progress(len(processed), len(batches))
+        except (BrokenProcessPool, OSError) as e:
+            print(f"Process pool failed ({e}), processing spectra serially")
+            if executor is not None:
+                discard_executor(executor)
+            processed = None
+    if processed is None:
+        processed = []
+        for chunk in tqdm(batch_paths, desc="Processing Spectra"):
+            processed.append(worker(chunk))
+            if progress is not None:
+                progress(len(processed), len(batches))
+
+    for batch, batch_results in zip(batches, processed):
+        for index, result in zip(batch, batch_results):
+            results[index] = result
+    return results
 
 def eclab_voltage(processed_voltage_df, start_time, end_time):
     # Ensure start_time and end_time are in datetime format
@@ -133,78 +552,122 @@ def eclab_voltage(processed_voltage_df, start_time, end_time):
     return volt_df
 
 
-def process_eclab(directory):
+# MPR columns used by parse_eclab, the file is memory-mapped and only these columns are loaded
+ECLAB_COLUMNS = ['time/s', 'Ewe/V', '(Q-Qo)/mA.h', 'half cycle', 'Q charge/discharge/mA.h']
 
-    print("Processing ECLab data")
-    eclabfiles = utils.identify_eclab_files(directory)
-    print("ECLab files identified")
-    mpr_file_path = eclabfiles[0]
-    mpl_file = eclabfiles[1]
-    # Read the MPR file (problematic)
-    try:
-        mpr_file = BioLogic.MPRfile(mpr_file_path)
-        print("MPR file loaded successfully")
-    except Exception as e:
-        print(f"Error loading MPR file: {e}")
-        raise
-    print("MPR file read...")
-    df = pd.DataFrame(mpr_file.data)
-    pd.set_option('display.max_columns', None)
-    print(df)
+# Parsed ECLab frames per .mpr/.mpt path, reused for as long as the data and .mpl files are unchanged
+_eclab_cache = {}
+_eclab_lock = threading.Lock()
 
-    def extract_start_time(mpl_file_path):
-        print("Extracting start time")
-        # Extracts the start time from an MPL file
-        with open(mpl_file_path, 'r', encoding='ISO-8859-1') as file:
-            for line in file:
-                if line.startswith('Acquisition started on :'):
-                    timestamp = line.split(':')[1].strip()
-                    return pd.to_datetime(timestamp)
 
-    # Convert 'Q charge/discharge' values to absolute values
-    df['Abs_Q_charge_discharge'] = df['Q charge/discharge/mA.h'].abs()
+def eclab_file_key(*file_paths):
+    """Size and modification time of every existing file, changes whenever one of them is written."""
+    key = []
+    for file_path in file_paths:
+        if file_path is not None and os.path.exists(file_path):
+            stat = os.stat(file_path)
+            key.append((file_path, stat.st_size, stat.st_mtime_ns))
+    return tuple(key)
 
-    # Map half cycles to full cycle numbers, ensuring half cycles 0 and 1 are mapped to full cycle 1
-    df['Full_Cycle_Number'] = ((df['half cycle'] // 2) + 1).astype(int)
 
-    is_charge = df['half cycle'] % 2 == 0  # If first cycle (0) is charge, then this is true
-    is_discharge = ~is_charge  # The opposite for discharge cycles
+def eclab_folder_key(directory):
+    """File key of the ECLab files of a folder that process_eclab reads, changes whenever they are written."""
+    mpr_file_path, mpl_file, mpt_file_path = utils.identify_eclab_files(directory)
+    return eclab_file_key(mpr_file_path or mpt_file_path, mpl_file)
+
+
+def process_eclab(directory):
+    """Return the per-cycle and per-point ECLab frames of a folder, shared by all callbacks.
+
+    The frames are cached and must be treated as read-only by callers.
+    """
+    mpr_file_path, mpl_file, mpt_file_path = utils.identify_eclab_files(directory)
+    data_file_path = mpr_file_path or mpt_file_path
+    with _eclab_lock:
+        key = eclab_file_key(data_file_path, mpl_file)
+        cached = _eclab_cache.get(data_file_path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        # Read the MPR file (problematic)
+        try:
+            if mpr_file_path is None:
+                # Only a text export, follow it and parse just the lines written since the last poll
+                eclab_file = cached[2] if cached is not None else BioLogic.MPTfollower(mpt_file_path, encoding='latin1')
+                new_records = eclab_file.poll()
+                if new_records is None:
+                    raise ValueError(f"MPT header of {mpt_file_path} is not complete yet")
+                print(f"{len(new_records)} new MPT lines read")
+            elif cached is not None:
+                # Running experiment, only decode the records appended since the last read
+                eclab_file = cached[2]
+                print(f"{eclab_file.update()} new MPR records read")
+            else:
+                eclab_file = BioLogic.MPRfile(mpr_file_path, memory_map=True, columns=ECLAB_COLUMNS)
+                print("MPR file loaded successfully")
+        except Exception as e:
+            print(f"Error loading ECLab file: {e}")
+            raise
+
+        processed = parse_eclab(eclab_file, mpl_file)
+        _eclab_cache[data_file_path] = (key, processed, eclab_file)
+        return processed
 
-    charge_capacity = df[is_charge].groupby('Full_Cycle_Number')['Abs_Q_charge_discharge'].max()
-    discharge_capacity = df[is_discharge].groupby('Full_Cycle_Number')['Abs_Q_charge_discharge'].max()
 
-    coulombic_efficiency = (discharge_capacity / charge_capacity) * 100
+def extract_mpl_start_time(mpl_file_path):
+    """Acquisition start time of an MPL file, only the first colon separates the label from the timestamp."""
+    with open(mpl_file_path, 'r', encoding='ISO-8859-1') as file:
+        for line in file:
+            if line.startswith('Acquisition started on :'):
+                timestamp = line.split(':', 1)[1].strip()
+                return pd.to_datetime(timestamp)
+
+
+def parse_eclab(mpr_file, mpl_file):
+    """Build the per-cycle and per-point frames from an MPR file or followed MPT export, with every cycle aggregate in one groupby."""
+
+    print("Processing ECLab data")
+    df = pd.DataFrame(mpr_file.data)
 
     if mpl_file is not None and os.path.exists(mpl_file):
-        start_time = extract_start_time(mpl_file)
+        print("Extracting start time")
+        start_time = extract_mpl_start_time(mpl_file)
     else:
         start_time = pd.to_datetime(mpr_file.timestamp)
 
-    df['Absolute_Time_UTC'] = df['time/s'].apply(lambda s: start_time + timedelta(seconds=s))
-    df['Abs_Q_charge_discharge'] = df['Q charge/discharge/mA.h'].abs()
+    # Absolute timestamps in a single vectorized datetime64 addition
+    df['Absolute_Time_UTC'] = start_time + pd.to_timedelta(df['time/s'], unit='s')
 
-    time = df.groupby('Full_Cycle_Number')['time/s'].max()
-    time_utc = df.groupby('Full_Cycle_Number')['Absolute_Time_UTC'].max()
+    # Map half cycles to full cycle numbers, ensuring half cycles 0 and 1 are mapped to full cycle 1
+    half_cycle = df['half cycle'].to_numpy()
+    is_charge = half_cycle % 2 == 0  # If first cycle (0) is charge, then this is true
+    abs_q = np.abs(df['Q charge/discharge/mA.h'].to_numpy())
+
+    # Charge and discharge capacities are the largest |Q| of the charge and discharge half of each cycle
+    cycles = pd.DataFrame({
+        'Full_Cycle_Number': (half_cycle // 2 + 1).astype(int),
+        'Charge_Capacity': np.where(is_charge, abs_q, np.nan),
+        'Discharge_Capacity': np.where(is_charge, np.nan, abs_q),
+        'Time': df['time/s'].to_numpy(),
+    }).groupby('Full_Cycle_Number').max()
+
+    # Efficiency stays NaN for cycles that are missing their charge or discharge half
+    coulombic_efficiency = (cycles['Discharge_Capacity'] / cycles['Charge_Capacity']) * 100
 
-    cycle_numbers = charge_capacity.index.union(discharge_capacity.index)
     processed_cycle_df = pd.DataFrame({
-        'Cycle_Number': cycle_numbers,
-        'Charge_Capacity': charge_capacity.reindex(cycle_numbers, fill_value=0),
-        'Discharge_Capacity': discharge_capacity.reindex(cycle_numbers, fill_value=0),
-        'Coulombic Efficiency': coulombic_efficiency.reindex(cycle_numbers, fill_value=100),
-        'Time': time.reindex(cycle_numbers, fill_value=0),
-        'Timestamp': time_utc.reindex(cycle_numbers, fill_value=0)
+        'Cycle_Number': cycles.index,
+        'Charge_Capacity': cycles['Charge_Capacity'].fillna(0),
+        'Discharge_Capacity': cycles['Discharge_Capacity'].fillna(0),
+        'Coulombic Efficiency': coulombic_efficiency,
+        'Time': cycles['Time'],
+        'Timestamp': start_time + pd.to_timedelta(cycles['Time'], unit='s')
     })
 
-    full_time = df['time/s']
-    full_volt = df['Ewe/V']
-    full_time_utc = df['Absolute_Time_UTC']
-    qq0 = df['(Q-Qo)/mA.h']
     processed_voltage_df = pd.DataFrame({
-        'Time':full_time,
-        'Timestamp':full_time_utc,
-        'Voltage':full_volt,
-        'Q_minus_Q0':qq0
+        'Time': df['time/s'],
+        'Timestamp': df['Absolute_Time_UTC'],
+        'Voltage': df['Ewe/V'],
+        'Q_minus_Q0': df['(Q-Qo)/mA.h']
     })
 
     print('MPR Processed')
@@ -213,30 +676,61 @@ def process_eclab(directory):
     return processed_cycle_df, processed_voltage_df
 
 
-def integrate_spectrum(path, integration_limits):
-    #print("Integrating: ", path)
-    dic, data, p0, p1, runtime, obs, sw, car = process_nmr_data(path, 'Varian', apply_autophase=True, p0=0.0, p1=0.0)
-    uc = ng.pipe.make_uc(dic, data)
-    ppm_scale = np.array(uc.ppm_scale(), dtype=float)
+def match_spectra_to_times(sample_times, nmr_times):
+    """Index labels of the spectra nearest in time to any of sample_times, each spectrum once and in time order.
+
+    nmr_times is a Series of spectrum times, the samples are matched with a sorted nearest-neighbour merge.
+    """
+    samples = pd.DataFrame({'time': pd.to_datetime(pd.Series(sample_times)).astype('datetime64[ns]')})
+    spectra = pd.DataFrame({'time': pd.to_datetime(nmr_times).astype('datetime64[ns]'), 'spectrum': nmr_times.index})
+    samples = samples.dropna().sort_values('time')
+    spectra = spectra.dropna().sort_values('time')
+    if samples.empty or spectra.empty:
+        return []
+    matched = pd.merge_asof(samples, spectra, on='time', direction='nearest')
+    return list(spectra.loc[spectra['spectrum'].isin(matched['spectrum']), 'spectrum'])
+
 
+def nearest_ppm_index(ppm_scale, ppm):
+    """Index of the point closest to ppm on a descending ppm scale, ties go to the lower index like argmin."""
+    ascending = ppm_scale[::-1]
+    position = int(np.clip(np.searchsorted(ascending, ppm), 1, len(ascending) - 1))
+    if ppm - ascending[position - 1] < ascending[position] - ppm:
+        position -= 1
+    return len(ppm_scale) - 1 - position
+
+
+def integral_table(data, ppm_scale):
+    """Cumulative trapezoid integral of |data| along the ppm axis, for one spectrum or a 2D stack.
+
+    The integral between indices i <= j is table[..., j] - table[..., i], the same value as
+    np.trapz(np.abs(data[..., i:j + 1]), x=ppm_scale[i:j + 1]).
+    """
+    magnitude = np.abs(data).astype(np.float64)
+    steps = 0.5 * (magnitude[..., 1:] + magnitude[..., :-1]) * np.diff(ppm_scale)
+    table = np.zeros(magnitude.shape, dtype=np.float64)
+    np.cumsum(steps, axis=-1, out=table[..., 1:])
+    return table
+
+
+def integrate_regions(table, ppm_scale, integration_limits):
+    """Integrate every (name, start, end) region from an integral table, per row when the table is 2D."""
     results = []
     for name, start, end in integration_limits:
         start = float(start)  # Convert start to float
         end = float(end)  # Convert end to float
 
-        # Extract the peak
-        # Find nearest ppm indices for start and end values
-        min_index = np.abs(ppm_scale - start).argmin()
-        max_index = np.abs(ppm_scale - end).argmin()
-        peak = data[max_index:min_index + 1]
-        peak_scale = ppm_scale[max_index:min_index + 1]
-
-        # Integrate using the trapezoidal rule
-        integral = np.trapz(np.abs(peak), x=peak_scale)
+        # Find nearest ppm indices for start and end values, end is the higher ppm and so the lower index
+        min_index = nearest_ppm_index(ppm_scale, start)
+        max_index = nearest_ppm_index(ppm_scale, end)
+        if max_index <= min_index:
+            integral = table[..., min_index] - table[..., max_index]
+        else:
+            integral = np.zeros(table.shape[:-1])[()]
         results.append((name, start, end, integral))
-
     return results
 
+
 def extract_eclab_start(directory):
 
     eclabfiles = utils.identify_eclab_files(directory)
@@ -245,16 +739,8 @@ def extract_eclab_start(directory):
     mpr_file = BioLogic.MPRfile(mpr_file_path)
     df = pd.DataFrame(mpr_file.data)
 
-    def extract_start_time(mpl_file_path):
-        # Extracts the start time from an MPL file
-        with open(mpl_file_path, 'r', encoding='ISO-8859-1') as file:
-            for line in file:
-                if line.startswith('Acquisition started on :'):
-                    timestamp = line.split(':')[1].strip()
-                    return pd.to_datetime(timestamp)
-
     if mpl_file is not None and os.path.exists(mpl_file):
-        start_time = extract_start_time(mpl_file)
+        start_time = extract_mpl_start_time(mpl_file)
     else:
         start_time = pd.to_datetime(mpr_file.timestamp)
     print("start time:")
@@ -0,0 +1,110 @@
+import numpy as np
+
+# Points sent to the browser per trace, independent of how long the experiment has been running
+MAX_POINTS = 4000
+
+# Pixel budget of the heatmap, columns along the ppm axis and rows along the time axis
+HEATMAP_COLUMNS = 1000
+HEATMAP_ROWS = 800
+
+
+def minmax_indices(y, max_points=MAX_POINTS):
+    """Indices of the points kept when y is reduced to about max_points points, in their original order.
+
+    The samples are split into max_points // 2 equal buckets and the minimum and maximum of every bucket is kept,
+    together with the first and last sample, so spikes and the overall envelope survive the reduction.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = y.shape[0]
+    if n <= max_points:
+        return np.arange(n)
+
+    per_bucket = -(-n // max(max_points // 2, 1))
+    n_full = (n // per_bucket) * per_bucket
+    # NaN gaps must not win the comparisons, they are replaced by the neighbouring extreme values
+    low = np.where(np.isnan(y), np.inf, y)
+    high = np.where(np.isnan(y), -np.inf, y)
+    offsets = np.arange(0, n_full, per_bucket)
+    kept = [
+        [0, n - 1],
+        offsets + low[:n_full].reshape(-1, per_bucket).argmin(axis=1),
+        offsets + high[:n_full].reshape(-1, per_bucket).argmax(axis=1),
+    ]
+    if n_full < n:
+        kept.append([n_full + low[n_full:].argmin(), n_full + high[n_full:].argmax()])
+
+    return np.unique(np.concatenate(kept))
+
+
+def decimate(x, y, max_points=MAX_POINTS):
+    """x and y reduced to about max_points points, x is the ordered (time) axis."""
+    x = np.asarray(x)
+    y = np.asarray(y)
+    indices = minmax_indices(y, max_points)
+    return x[indices], y[indices]
+
+
+def max_bins(values, bin_limit, axis):
+    """Reduce values along axis to at most bin_limit bins of consecutive samples, keeping the maximum of each bin.
+
+    Returns the reduced array and the bin size. Taking the maximum instead of the mean keeps narrow peaks visible.
+    """
+    n = values.shape[axis]
+    bin_size = max(-(-n // bin_limit), 1)
+    if bin_size == 1:
+        return values, 1
+
+    n_bins = -(-n // bin_size)
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (0, n_bins * bin_size - n)
+    padded = np.pad(values, pad, constant_values=-np.inf)
+    shape = values.shape[:axis] + (n_bins, bin_size) + values.shape[axis + 1:]
+    return padded.reshape(shape).max(axis=axis + 1), bin_size
+
+
+def bin_centres(axis_values, bin_size):
+    """Mean coordinate of every bin of bin_size consecutive values, the last bin may be shorter."""
+    axis_values = np.asarray(axis_values, dtype=np.float64)
+    if bin_size == 1:
+        return axis_values
+    starts = np.arange(0, axis_values.shape[0], bin_size)
+    return np.add.reduceat(axis_values, starts) / np.diff(np.append(starts, axis_values.shape[0]))
+
+
+def rasterize(x, y, z, max_columns=HEATMAP_COLUMNS, max_rows=HEATMAP_ROWS):
+    """Heatmap reduced to the pixel budget, as float32 so plotly ships it as a compact binary array.
+
+    x is the ppm axis (columns of z) and y the time axis (rows of z). Columns are binned first, then rows, both
+    with the bin maximum, and the axes are replaced by the bin centres.
+    """
+    z = np.asarray(z, dtype=np.float32)
+    if z.ndim != 2 or z.size == 0:
+        return np.asarray(x), np.asarray(y), z
+    z, column_size = max_bins(z, max_columns, axis=1)
+    z, row_size = max_bins(z, max_rows, axis=0)
+    return bin_centres(x, column_size), bin_centres(y, row_size), z
+
+
+def window(x, start, end):
+    """Slice of the sorted array x that lies between start and end."""
+    return slice(np.searchsorted(x, start, side='left'), np.searchsorted(x, end, side='right'))
+
+
+def relayout_range(relayout_data, axes):
+    """Zoomed range of the first of axes in a relayoutData event.
+
+    Returns (low, high) for a zoom, None when the axis was reset to autorange and False when the event did not
+    touch the axis (e.g. a resize or a zoom of another subplot).
+    """
+    if not relayout_data:
+        return False
+    for axis in axes:
+        if f'{axis}.range[0]' in relayout_data and f'{axis}.range[1]' in relayout_data:
+            low, high = relayout_data[f'{axis}.range[0]'], relayout_data[f'{axis}.range[1]']
+            return min(low, high), max(low, high)
+        if f'{axis}.range' in relayout_data:
+            low, high = relayout_data[f'{axis}.range']
+            return min(low, high), max(low, high)
+        if relayout_data.get(f'{axis}.autorange'):
+            return None
+    return False
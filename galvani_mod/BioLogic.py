@@ -9,6 +9,8 @@ __all__ = ["MPTfileCSV", "MPTfile"]
 
 import re
 import csv
+import mmap
+from io import BytesIO
 from os import SEEK_SET, path
 import time
 from datetime import date, datetime, timedelta
@@ -56,7 +58,7 @@ def fieldname_to_dtype(fieldname):
         "|Permittivity|",
         "Tan(Delta)",
     ):
-        return (fieldname, np.float_)
+        return (fieldname, np.float64)
     elif fieldname in (
         "Q charge/discharge/mA.h",
         "step time/s",
@@ -69,15 +71,15 @@ def fieldname_to_dtype(fieldname):
         "rotation rate/rpm",
         "pad number",
     ):
-        return (fieldname, np.float_)
+        return (fieldname, np.float64)
     elif fieldname in ("cycle number", "I Range", "Ns", "half cycle", "z cycle"):
         return (fieldname, np.int_)
     elif fieldname in ("dq/mA.h", "dQ/mA.h"):
-        return ("dQ/mA.h", np.float_)
+        return ("dQ/mA.h", np.float64)
     elif fieldname in ("I/mA", "<I>/mA"):
-        return ("I/mA", np.float_)
+        return ("I/mA", np.float64)
     elif fieldname in ("Ewe/V", "<Ewe>/V", "Ecell/V", "<Ewe/V>", "<Ecell/V>"):
-        return ("Ewe/V", np.float_)
+        return ("Ewe/V", np.float64)
     elif fieldname.endswith(
         (
             "/s",
@@ -109,9 +111,9 @@ def fieldname_to_dtype(fieldname):
             "/mol.L-1",
         )
     ):
-        return (fieldname, np.float_)
+        return (fieldname, np.float64)
     elif fieldname.startswith("Custom"):
-        return (fieldname, np.float_)
+        return (fieldname, np.float64)
     else:
         raise ValueError("Invalid column header: %s" % fieldname)
 
@@ -122,18 +124,35 @@ def comma_converter(float_text):
     return float(float_text.translate(trans_table))
 
 
-def MPTfile(file_or_path, encoding="ascii"):
-    """Opens .mpt files as numpy record arrays
+# Number of bytes of .mpt data parsed at a time
+MPT_CHUNK_SIZE = 16 * 1024 * 1024
 
-    Checks for the correct headings, skips any comments and returns a
-    numpy record array object and a list of comments
+
+def parse_mpt_lines(lines, record_type):
+    """Parse complete lines of tab separated .mpt data into a record array
+
+    Decimal commas are replaced in bulk on the byte buffer, so the rows can be
+    read as floats by numpy's C parser and then cast column by column into
+    the record type.
     """
+    if not lines.strip():
+        return np.empty(0, dtype=record_type)
+    # Must be able to parse files where commas are used for decimal points
+    values = np.loadtxt(
+        BytesIO(lines.replace(b",", b".")), dtype=np.float64, ndmin=2, encoding="latin1"
+    )
+    records = np.empty(values.shape[0], dtype=record_type)
+    for column, name in enumerate(record_type.names):
+        records[name] = values[:, column]
+    return records
 
-    if isinstance(file_or_path, str):
-        mpt_file = open(file_or_path, "rb")
-    else:
-        mpt_file = file_or_path
 
+def read_mpt_header(mpt_file, encoding="ascii"):
+    """Reads the header of an .mpt file
+
+    Returns the list of comment lines and the numpy dtype of the data records,
+    leaving mpt_file positioned at the first data line.
+    """
     magic = next(mpt_file)
     if magic not in (b"EC-Lab ASCII FILE\r\n", b"BT-Lab ASCII FILE\r\n"):
         raise ValueError("Bad first line for EC-Lab file: '%s'" % magic)
@@ -150,13 +169,135 @@ def MPTfile(file_or_path, encoding="ascii"):
     fieldnames = next(mpt_file).decode(encoding).strip().split("\t")
     record_type = np.dtype(list(map(fieldname_to_dtype, fieldnames)))
 
-    # Must be able to parse files where commas are used for decimal points
-    converter_dict = dict(((i, comma_converter) for i in range(len(fieldnames))))
-    mpt_array = np.loadtxt(mpt_file, dtype=record_type, converters=converter_dict)
+    return comments, record_type
+
+
+def read_mpt_lines(mpt_file, record_type):
+    """Parses the data lines from the current position to the end of mpt_file
+
+    The data is read in chunks of whole lines, each chunk parsed with numpy's
+    C parser. Returns the record array of all complete lines and the bytes
+    after the last newline, which may be an unfinished line.
+    """
+    chunks = [np.empty(0, dtype=record_type)]
+    remainder = b""
+    while True:
+        block = mpt_file.read(MPT_CHUNK_SIZE)
+        if not block:
+            break
+        block = remainder + block
+        last_newline = block.rfind(b"\n") + 1
+        chunks.append(parse_mpt_lines(block[:last_newline], record_type))
+        remainder = block[last_newline:]
+
+    return np.concatenate(chunks), remainder
+
+
+def MPTfile(file_or_path, encoding="ascii"):
+    """Opens .mpt files as numpy record arrays
+
+    Checks for the correct headings, skips any comments and returns a
+    numpy record array object and a list of comments
+    """
+
+    if isinstance(file_or_path, str):
+        mpt_file = open(file_or_path, "rb")
+    else:
+        mpt_file = file_or_path
+
+    comments, record_type = read_mpt_header(mpt_file, encoding)
+    mpt_array, remainder = read_mpt_lines(mpt_file, record_type)
+    if remainder:
+        mpt_array = np.concatenate([mpt_array, parse_mpt_lines(remainder, record_type)])
+    if isinstance(file_or_path, str):
+        mpt_file.close()
 
     return mpt_array, comments
 
 
+class MPTfollower:
+    """Follows an .mpt file that is still being written by EC-Lab
+
+    The header is parsed once, after which every call to poll() parses only
+    the lines appended since the previous call. A partially written last line
+    is held back until it is complete. All records read so far are kept in
+    the growable record array self.data.
+
+    Attributes
+    ----------
+    data : numpy record array of all complete lines read so far
+    comments : list of the header comment lines
+    timestamp : datetime of the start of the acquisition, if in the header
+    offset : byte offset of the first line not yet consumed
+    """
+
+    def __init__(self, file_path, encoding="ascii"):
+        self.path = file_path
+        self.encoding = encoding
+        self.record_type = None
+        self.comments = []
+        self.timestamp = None
+        self.offset = 0
+        self.data = None
+        self._buffer = None
+
+    def _read_header(self, mpt_file):
+        """Parses the header once all its lines are written, returns False if it is still incomplete"""
+        mpt_file.seek(0, SEEK_SET)
+        head = mpt_file.read(MPT_CHUNK_SIZE)
+        lines = head.split(b"\n")
+        nb_headers_match = len(lines) > 2 and re.match(rb"Nb header lines : (\d+)\s*$", lines[1])
+        if not nb_headers_match or len(lines) <= int(nb_headers_match.group(1)):
+            return False
+
+        nb_headers = int(nb_headers_match.group(1))
+        header = b"\n".join(lines[:nb_headers]) + b"\n"
+        self.comments, self.record_type = read_mpt_header(BytesIO(header), self.encoding)
+        self.timestamp = acquisition_start(
+            b"".join(self.comments).decode(self.encoding, errors="replace")
+        )
+        self.offset = len(header)
+        self.data = np.empty(0, dtype=self.record_type)
+        self._buffer = None
+        return True
+
+    def poll(self):
+        """Parses the lines completed since the last poll
+
+        Returns
+        -------
+        new_records : numpy record array of the new lines, or None while the
+            header has not been written completely.
+        """
+        with open(self.path, "rb") as mpt_file:
+            size = mpt_file.seek(0, 2)
+            if self.record_type is not None and size < self.offset:
+                # The file was truncated or rewritten, start over
+                self.record_type = None
+            if self.record_type is None and not self._read_header(mpt_file):
+                return None
+
+            mpt_file.seek(self.offset, SEEK_SET)
+            new_records, remainder = read_mpt_lines(mpt_file, self.record_type)
+            self.offset = mpt_file.tell() - len(remainder)
+
+        self._append(new_records)
+        return new_records
+
+    def _append(self, new_records):
+        """Appends to self.data, growing its buffer geometrically"""
+        n_old = self.data.shape[0]
+        n_total = n_old + new_records.shape[0]
+        if n_total == n_old:
+            return
+        if self._buffer is None or self._buffer.shape[0] < n_total:
+            buffer = np.empty(max(n_total, 2 * n_old), dtype=self.record_type)
+            buffer[:n_old] = self.data
+            self._buffer = buffer
+        self._buffer[n_old:n_total] = new_records
+        self.data = self._buffer[:n_total]
+
+
 def MPTfileCSV(file_or_path):
     """Simple function to open MPT files as csv.DictReader objects
 
@@ -681,15 +822,23 @@ def timestamp_from_file(file: str, encoding: str ="latin1"):
         if line not in LOG_MAGIC:
             raise ValueError("Invalid magic for .mpl file")
         log = f.read()
-    start = tuple(
-        map(
-            int,
-            re.findall(
-                r"Acquisition started on : (\d+)\/(\d+)\/(\d+) (\d+):(\d+):(\d+)\.(\d+)",
-                "".join(log),
-            )[0],
-        )
+    start = acquisition_start(log)
+    if start is None:
+        raise IndexError("No acquisition start time in .mpl file")
+    return start
+
+
+def acquisition_start(log):
+    """Parses the 'Acquisition started on' line of an .mpl log or .mpt header
+
+    Returns None if the line is not present.
+    """
+    found = re.findall(
+        r"Acquisition started on : (\d+)\/(\d+)\/(\d+) (\d+):(\d+):(\d+)\.(\d+)", log
     )
+    if not found:
+        return None
+    start = tuple(map(int, found[0]))
     return datetime(
         int(start[2]), start[0], start[1], start[3], start[4], start[5], start[6] * 1000
     )
@@ -714,17 +863,29 @@ class MPRfile:
            array of the file.
     startdate - The date when the experiment started
     enddate - The date when the experiment finished
+
+    With memory_map=True the file is memory-mapped and data is a read-only
+    view of the records in place, rather than a copy read into memory.
+    columns optionally restricts data to the named fields, e.g.
+    ["time/s", "Ewe/V"], so callers only materialise the columns they use.
     """
 
-    def __init__(self, file_or_path):
+    def __init__(self, file_or_path, memory_map=False, columns=None):
         self.loop_index = None
         self.startdate = None
         self.enddate = None
         self.timestamp = None
+        self._path = None
+        self._buffer = None
+        self._mmap = None
+        self._memory_map = memory_map
+        self._columns = None
         if isinstance(file_or_path, str):
             mpr_file = open(file_or_path, "rb")
             loop_file = file_or_path[:-4] + "_LOOP.txt"  # loop file for running experiment
             log_file = file_or_path[:-1] + "l"  # log file for runnning experiment
+            self._path = file_or_path
+            self._loop_file = loop_file
         else:
             mpr_file = file_or_path
         magic = mpr_file.read(len(MPR_MAGIC))
@@ -733,7 +894,17 @@ class MPRfile:
                 mpr_file.close()
             raise ValueError("Invalid magic for .mpr file: %s" % magic)
 
-        modules = list(read_VMP_modules(mpr_file))
+        modules = list(read_VMP_modules(mpr_file, read_module_data=not memory_map))
+        if memory_map:
+            # Only the small metadata modules are copied, the data module stays a view of the file
+            self._mmap = mmap.mmap(mpr_file.fileno(), 0, access=mmap.ACCESS_READ)
+            file_view = memoryview(self._mmap)
+            for module in modules:
+                module_data = file_view[module["offset"] : module["offset"] + module["length"]]
+                if module["shortname"] == b"VMP data  ":
+                    module["data"] = module_data
+                else:
+                    module["data"] = module_data.tobytes()
         if isinstance(file_or_path, str):
             mpr_file.close()
 
@@ -784,6 +955,17 @@ class MPRfile:
         self.dtype, self.flags_dict = VMPdata_dtype_from_colIDs(column_types)
         self.data = np.frombuffer(main_data, dtype=self.dtype)
         assert self.data.shape[0] == n_data_points
+        if columns is not None:
+            self._columns = [name for name in columns if name in self.dtype.names]
+            self.data = self.data[self._columns]
+
+        # Location of the data module and of its first record, used by update() to read appended records
+        if "max length" in data_module:
+            self._data_module_hdr = VMPmodule_hdr_v2
+        else:
+            self._data_module_hdr = VMPmodule_hdr_v1
+        self._data_module_offset = data_module["offset"]
+        self._records_offset = data_module["offset"] + len(data_module["data"]) - len(main_data)
 
         # No idea what these 'column types' mean or even if they are actually
         # column types at all
@@ -837,6 +1019,97 @@ class MPRfile:
             if path.isfile(log_file):
                 self.timestamp = timestamp_from_file(log_file)
 
+    def update(self):
+        """Read the records appended to the data module since the file was last read
+
+        While an experiment is running, EC-Lab appends records to the data module
+        and updates its point count. Only the records added since the previous
+        read are decoded, and they are appended to a growable copy of the data
+        array. If the data module moved or shrank, or the file was truncated
+        (e.g. it was rewritten when the experiment finished), the whole file is
+        read again.
+
+        Returns
+        -------
+        n_new : int
+            Number of records added to self.data.
+        """
+        if self._path is None:
+            raise ValueError("update() needs an MPRfile opened from a path")
+
+        n_old = self.data.shape[0]
+        hdr_dtype = self._data_module_hdr
+        with open(self._path, "rb") as mpr_file:
+            mpr_file.seek(self._data_module_offset - hdr_dtype.itemsize - len(b"MODULE"), SEEK_SET)
+            hdr_bytes = mpr_file.read(len(b"MODULE") + hdr_dtype.itemsize)
+            n_data_points = np.frombuffer(mpr_file.read(4), dtype="<u4")
+            if (
+                hdr_bytes[:6] != b"MODULE"
+                or hdr_bytes[6:16] != b"VMP data  "
+                or n_data_points.size == 0
+                or n_data_points[0] < n_old
+            ):
+                return self._reopen(n_old)
+
+            hdr = np.frombuffer(hdr_bytes[6:], dtype=hdr_dtype, count=1)
+            module_end = self._data_module_offset + int(hdr["length"][0])
+            file_end = mpr_file.seek(0, 2)
+            n_records = (min(module_end, file_end) - self._records_offset) // self.dtype.itemsize
+            if n_records < n_old:
+                # The file was truncated or is being rewritten while the point count stayed
+                return self._reopen(n_old)
+            n_total = min(int(n_data_points[0]), n_records)
+            if n_total <= n_old:
+                return 0
+
+            if self._mmap is not None:
+                # Map the grown file again, the records stay in place so nothing is copied
+                self._mmap = mmap.mmap(mpr_file.fileno(), 0, access=mmap.ACCESS_READ)
+                new_records = None
+            else:
+                mpr_file.seek(self._records_offset + n_old * self.dtype.itemsize, SEEK_SET)
+                new_records = np.frombuffer(
+                    mpr_file.read((n_total - n_old) * self.dtype.itemsize), dtype=self.dtype
+                )
+
+        if new_records is None:
+            self.data = np.frombuffer(
+                self._mmap, dtype=self.dtype, count=n_total, offset=self._records_offset
+            )
+            if self._columns is not None:
+                self.data = self.data[self._columns]
+        else:
+            if self._columns is not None:
+                new_records = new_records[self._columns]
+            if self._buffer is None or self._buffer.shape[0] < n_total:
+                buffer = np.empty(max(n_total, 2 * n_old), dtype=self.data.dtype)
+                buffer[:n_old] = self.data
+                self._buffer = buffer
+            self._buffer[n_old:n_total] = new_records
+            self.data = self._buffer[:n_total]
+        self.npts = n_total
+
+        if path.isfile(self._loop_file) and not any(
+            m["shortname"] == b"VMP loop  " for m in self.modules
+        ):
+            self.loop_index = loop_from_file(self._loop_file)
+            if self.loop_index[-1] < n_total:
+                self.loop_index = np.append(self.loop_index, n_total)
+
+        return n_total - n_old
+
+    def _reopen(self, n_old):
+        """Read the whole file again after it was rewritten, returns the change in the number of records
+
+        The old data is dropped first: a memory-mapped view of records that are
+        no longer in the file raises SIGBUS when it is read, rather than an error.
+        """
+        self.data = np.empty(0, dtype=self.data.dtype)
+        self._mmap = None
+        self._buffer = None
+        self.__init__(self._path, self._memory_map, self._columns)
+        return self.data.shape[0] - n_old
+
     def get_flag(self, flagname):
         if flagname in self.flags_dict:
             mask, dtype = self.flags_dict[flagname]
@@ -0,0 +1,118 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Heavy callbacks running at the same time, the Dash request threads only submit jobs and poll them
+JOB_WORKERS = 4
+# Finished jobs whose result was never collected (e.g. the browser tab was closed) are forgotten after this many seconds
+JOB_TTL = 600
+
+_executor = None
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """Raised inside a job at its next progress update once a newer job of the same owner replaced it."""
+
+
+class Job:
+    """A callback running in the job pool.
+
+    The owner is e.g. (session_id, 'refresh') and has at most one job in the registry, key identifies the inputs
+    the job was started with.
+    """
+
+    def __init__(self, owner, key):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.key = key
+        self.stage = 'Queued'
+        self.percent = 0
+        self.finished_at = None
+        self.future = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Drop the job if it has not started yet, otherwise stop it at its next progress update."""
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def progress(self, stage, percent):
+        """Publish the current stage and percentage, raises JobCancelled if the job was replaced."""
+        if self.cancelled:
+            raise JobCancelled(self.id)
+        self.stage = stage
+        self.percent = int(percent)
+
+    def steps(self, stage, start, end):
+        """Progress callback taking (done, total), as used by data_processing.process_spectra, mapped onto start..end."""
+        def report(done, total):
+            self.progress(stage, start + (end - start) * done / max(total, 1))
+        return report
+
+    def done(self):
+        return self.future.done()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='akkuspin-job')
+    return _executor
+
+
+def _run(job, func, args, kwargs):
+    try:
+        job.progress('Starting', 0)
+        return func(job, *args, **kwargs)
+    finally:
+        job.finished_at = time.time()
+
+
+def _prune():
+    expired = time.time() - JOB_TTL
+    for job_id, job in list(_jobs.items()):
+        if job.finished_at is not None and job.finished_at < expired:
+            del _jobs[job_id]
+
+
+def submit(owner, key, func, *args, **kwargs):
+    """Run func(job, *args, **kwargs) in the job pool and return the job.
+
+    A running job of owner with the same key is returned instead of starting a second one. A job of owner with
+    other inputs is stale: it is cancelled and dropped from the registry, so its result is never delivered.
+    """
+    with _jobs_lock:
+        _prune()
+        for job_id, job in list(_jobs.items()):
+            if job.owner != owner:
+                continue
+            if job.key == key and not job.done():
+                return job
+            job.cancel()
+            del _jobs[job_id]
+
+        job = Job(owner, key)
+        job.future = get_executor().submit(_run, job, func, args, kwargs)
+        _jobs[job.id] = job
+        return job
+
+
+def get_job(job_id):
+    """Job registered under job_id, None when it is unknown, stale or already collected."""
+    with _jobs_lock:
+        return _jobs.get(job_id) if job_id else None
+
+
+def collect(job_id):
+    """Remove a finished job from the registry and return its result, re-raising the error of a failed job."""
+    with _jobs_lock:
+        job = _jobs.pop(job_id)
+    return job.future.result()
@@ -1,4 +1,5 @@
 from dash import html, dcc
+import uuid
 import dash_bootstrap_components as dbc
 
 cyclerfolder = '/Users/fionnferreira/Downloads/BioLogic Files/flow_nmr'
@@ -101,13 +102,16 @@ def create_layout():
             html.H1("AkkuSpin", style={'text-align': 'center', 'padding': '20px 0', 'color': 'white', 'font-family': sans_serif_font}),
         ], style={'background-color': '#0047AB', 'color': 'white', 'margin': '0', 'padding': '0'}),
 
-        # Interval component for live updates
+        # Interval component for live updates, only asks the folder watcher whether new data arrived
         dcc.Interval(
             id='interval-component',
-            interval=900 * 1000,  # in milliseconds
+            interval=2 * 1000,  # in milliseconds
             n_intervals=0
         ),
 
+        # Version of the watched data, a live refresh starts when it changes
+        dcc.Store(id='data_version'),
+
         html.Div([
             # Global Settings
             html.Div([
@@ -172,10 +176,10 @@ def create_layout():
             html.Div([
                 html.H2("Plot Settings", style={'font-family': sans_serif_font, 'font-size': '18px', 'line-height': '1.5', 'padding': '10px', 'margin-top': '0'}),
                 html.Label("Min PPM:", style={'font-family': sans_serif_font, 'font-size': '16px'}),
-                dcc.Input(id='ppm_min_input', type='number', placeholder='Min PPM', value=-61,
+                dcc.Input(id='ppm_min_input', type='number', debounce=True, placeholder='Min PPM', value=-61,
                           style=input_style),
                 html.Label("Max PPM:", style={'font-family': sans_serif_font, 'font-size': '16px'}),
-                dcc.Input(id='ppm_max_input', type='number', placeholder='Max PPM', value=-57.5,
+                dcc.Input(id='ppm_max_input', type='number', debounce=True, placeholder='Max PPM', value=-57.5,
                           style=input_style),
                 html.Button('Update', id='update_button', n_clicks=0),
             ], style={'width': '32%', 'background-color': '#f7f7f7', 'padding': '20px', 'box-sizing': 'border-box'}),
@@ -187,8 +191,11 @@ def create_layout():
             style={'font-family': sans_serif_font, 'font-size': '16px'}
         ),
 
-        # Progress bar (added here)
-        dbc.Progress(id='progress-bar', value=0, striped=True, animated=True, style={'margin': '10px 0'}),
+        # Progress bar (added here), shows the stage of the running refresh or integration job
+        dbc.Progress(id='progress-bar', value=0, label='', striped=True, animated=True, style={'margin': '10px 0'}),
+
+        # Polls the running jobs, only enabled while one is running
+        dcc.Interval(id='job_poll', interval=500, n_intervals=0, disabled=True),
 
         # NMR Plot
         html.Div([
@@ -222,5 +229,19 @@ def create_layout():
         # Store component to save input states
         dcc.Store(id='input-storage', storage_type='local'),
 
+        # Identifies the browser session, server-side live state is kept per session
+        dcc.Store(id='session_id', data=str(uuid.uuid4())),
+
+        # Handles of the server-side data stages of each panel, a panel only rebuilds when its handle changes
+        dcc.Store(id='spectra_handle'),
+        dcc.Store(id='voltage_handle'),
+        dcc.Store(id='cycle_handle'),
+        dcc.Store(id='first_last_handle'),
+        dcc.Store(id='fid_handle'),
+
+        # Ids of the refresh and integration jobs of this session in the job pool
+        dcc.Store(id='refresh_job'),
+        dcc.Store(id='integration_job'),
+
         html.Div(id='dummy_div')
     ], style={'max-width': '90%', 'margin': '0 auto'})
@@ -0,0 +1,156 @@
+import bisect
+import threading
+from collections import OrderedDict
+import numpy as np
+from dash import Patch, no_update
+import decimation
+import plotting
+from spectral_stack import SpectralStack
+
+# Number of browser sessions whose live spectra are kept in memory, the least recently used is dropped first
+MAX_SESSIONS = 8
+
+_sessions = OrderedDict()
+_views = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+class SpectrumSeries(SpectralStack):
+    """Processed spectra of one nucleus kept in time order, in live mode one series is kept per browser session."""
+
+    def __init__(self, key):
+        super().__init__()
+        self.key = key
+
+    def new_paths(self, spectra_paths):
+        """Paths in spectra_paths that have not been processed yet, oldest first."""
+        seen = set(self.paths)
+        return sorted(path for path in spectra_paths if path not in seen)
+
+
+class HeatmapView:
+    """Rows and voltage points the nmr_plot figure of a session shows, so a live tick only sends what was added.
+
+    The figure must hold the heatmap and the voltage traces as plain lists, a Patch cannot extend binary arrays.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.row_times = []
+        self.columns = 0
+        # (values, hours) of the voltage and Q traces
+        self.traces = [(np.empty(0), np.empty(0)), (np.empty(0), np.empty(0))]
+        self.voltage_end = None
+
+    def record(self, stack, columns, traces, volt_df):
+        """Remember a fully built figure, rows are only appended while the heatmap is not binned along time."""
+        self.row_times = list(stack.times) if len(stack) <= decimation.HEATMAP_ROWS else []
+        self.columns = columns
+        self.record_traces(traces, volt_df)
+
+    def record_traces(self, traces, volt_df):
+        """Remember the (values, hours) points of the voltage traces, e.g. after a zoom re-decimated them."""
+        self.traces = [(np.asarray(values, dtype=np.float64), np.asarray(hours, dtype=np.float64))
+                       for values, hours in traces]
+        self.voltage_end = volt_df['Timestamp'].max() if len(volt_df) else None
+
+    def patch(self, stack, volt_df, start_datetime, end_datetime, experiment_start_time):
+        """Patch that turns the recorded figure into the one for stack and volt_df.
+
+        Rows and points that left the time window are deleted from the front and the new ones appended, the new
+        voltage samples are decimated to their share of decimation.MAX_POINTS. Returns None when the figure has
+        to be rebuilt and no_update when nothing changed.
+        """
+        if not self.row_times or len(stack) > decimation.HEATMAP_ROWS:
+            return None
+        dropped = bisect.bisect_left(self.row_times, stack.times[0]) if len(stack) else len(self.row_times)
+        kept = self.row_times[dropped:]
+        if stack.times[:len(kept)] != kept:
+            # A spectrum turned up between rows that are already shown
+            return None
+        new_z, _ = decimation.max_bins(np.asarray(stack.data[len(kept):], dtype=np.float32),
+                                       decimation.HEATMAP_COLUMNS, axis=1)
+        if len(new_z) and new_z.shape[1] != self.columns:
+            return None
+        new_times = stack.times[len(kept):]
+
+        new_df = volt_df if self.voltage_end is None else volt_df[volt_df['Timestamp'] > self.voltage_end]
+        window_hours = max((end_datetime - start_datetime).total_seconds() / 3600, 1e-9)
+        new_hours = (new_df['Timestamp'].max() - new_df['Timestamp'].min()).total_seconds() / 3600 if len(new_df) else 0
+        budget = max(int(decimation.MAX_POINTS * min(new_hours / window_hours, 1)), 2)
+        (voltage, voltage_hours), (q, q_hours) = plotting.voltage_trace_points(new_df, experiment_start_time,
+                                                                              max_points=budget)
+        start_hours = (start_datetime - experiment_start_time).total_seconds() / 3600
+
+        patch = Patch()
+        changed = False
+        for _ in range(dropped):
+            del patch['data'][0]['z'][0]
+            del patch['data'][0]['y'][0]
+            changed = True
+        if new_times:
+            patch['data'][0]['z'].extend(new_z.tolist())
+            patch['data'][0]['y'].extend([(t - experiment_start_time).total_seconds() / 3600 for t in new_times])
+            changed = True
+
+        traces = []
+        for index, (values, hours), (shown_values, shown_hours) in zip((1, 2), ((voltage, voltage_hours), (q, q_hours)),
+                                                                       self.traces):
+            gone = int(np.searchsorted(shown_hours, start_hours, side='left'))
+            values = np.concatenate([shown_values[gone:], np.asarray(values, dtype=np.float64)])
+            hours = np.concatenate([shown_hours[gone:], np.asarray(hours, dtype=np.float64)])
+            added = len(hours) - len(shown_hours) + gone
+            if 3 * gone > len(shown_hours) - gone:
+                # A delete per point would be larger than sending the remaining points again
+                patch['data'][index]['x'] = values.tolist()
+                patch['data'][index]['y'] = hours.tolist()
+            else:
+                for _ in range(gone):
+                    del patch['data'][index]['x'][0]
+                    del patch['data'][index]['y'][0]
+                if added:
+                    patch['data'][index]['x'].extend(values[-added:].tolist())
+                    patch['data'][index]['y'].extend(hours[-added:].tolist())
+            changed = changed or gone > 0 or added > 0
+            traces.append((values, hours))
+
+        self.row_times = kept + list(new_times)
+        self.traces = traces
+        if len(new_df):
+            self.voltage_end = new_df['Timestamp'].max()
+        return patch if changed else no_update
+
+
+def _session_entry(entries, session_id, key, factory):
+    """Entry of a session in an LRU of MAX_SESSIONS sessions, a new one when the key changed."""
+    with _sessions_lock:
+        entry = entries.get(session_id)
+        if entry is None or entry.key != key:
+            entry = factory(key)
+        entries[session_id] = entry
+        entries.move_to_end(session_id)
+        while len(entries) > MAX_SESSIONS:
+            entries.popitem(last=False)
+        return entry
+
+
+def get_series(session_id, key):
+    """Return the live series of a session, starting a new one when the folder or processing settings changed."""
+    return _session_entry(_sessions, session_id, key, SpectrumSeries)
+
+
+def get_view(session_id, key):
+    """Return the heatmap view of a session, starting a new one when the data or ppm range of the figure changed."""
+    return _session_entry(_views, session_id, key, HeatmapView)
+
+
+def current_view(session_id):
+    """Heatmap view of a session, None when its figure was not built for live updates."""
+    with _sessions_lock:
+        return _views.get(session_id)
+
+
+def drop_view(session_id):
+    """Forget the heatmap view of a session, its next figure is built in full."""
+    with _sessions_lock:
+        _views.pop(session_id, None)
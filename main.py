@@ -5,7 +5,8 @@ import socket
 
 app = dash.Dash(__name__)
 
-app.layout = layout.create_layout()
+# Layout is built per page load so every browser session gets its own session id
+app.layout = layout.create_layout
 
 app.title = 'AkkuSpin'
 
@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import numpy as np
+import nmrglue as ng
+import data_processing
+
+# Spectra co-added for a phase estimate or a drift check
+PHASE_SAMPLES = 8
+# The co-added spectrum is binned down to at most this many points before ACME, so one autops call stays fast
+PHASE_POINTS = 16384
+# Rise of the phase error of new spectra over the error at estimation time that triggers a new estimate
+DRIFT_THRESHOLD = 0.1
+
+_phase_lock = threading.Lock()
+
+
+def phase_file():
+    return os.path.join(data_processing.CACHE_DIR, 'phases.json')
+
+
+def load_phases():
+    try:
+        with open(phase_file(), 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_phases(phases):
+    """Write the phase file with the writer of the spectrum cache, through a temporary file of its own."""
+    os.makedirs(data_processing.CACHE_DIR, exist_ok=True)
+    data_processing.replace_file(phase_file(), lambda file: json.dump(phases, file, indent=1), mode='w')
+
+
+def coadd(paths, nmr_format):
+    """Sum of the unphased spectra of paths, spectra with a different size than the first are left out."""
+    results = data_processing.process_spectra(paths, nmr_format, apply_autophase=False, p0=0.0, p1=0.0)
+    size = results[0][0].size
+    return np.sum([np.asarray(data, dtype=np.complex128) for meta, data in results if meta.size == size], axis=0)
+
+
+def estimate_phase(spectrum):
+    """ACME phase (p0, p1) of an unphased spectrum, estimated on a binned copy of at most PHASE_POINTS points.
+
+    Binning keeps the relative position of every point, so p1 carries over unchanged and p0 only needs the
+    offset of the bin centres.
+    """
+    size = len(spectrum)
+    bin_size = 1
+    while size // bin_size > PHASE_POINTS and size % (2 * bin_size) == 0:
+        bin_size *= 2
+    binned = spectrum.reshape(-1, bin_size).mean(axis=1)
+    binned, (p0, p1) = ng.proc_autophase.autops(binned, 'acme', return_phases=True, disp=False)
+    return float(p0 - p1 * (bin_size - 1) / (2 * size)), float(p1)
+
+
+def phase_error(spectrum, p0, p1):
+    """Share of the peak magnitude that is not absorptive after phasing, 0 for a perfectly phased spectrum."""
+    phased = ng.proc_base.ps(spectrum, p0=p0, p1=p1)
+    magnitude = np.abs(phased)
+    peaks = magnitude > 0.1 * magnitude.max()
+    return float(1 - phased.real[peaks].sum() / magnitude[peaks].sum())
+
+
+def series_phase(folder, nucleus, nmr_format, paths):
+    """(p0, p1) for the spectra of a folder and nucleus, paths in time order.
+
+    The phase is estimated once on a co-added sample spread over paths and stored in CACHE_DIR/phases.json.
+    When newer spectra arrive, their co-added phase error is compared with the error at estimation time and
+    the phase is estimated again on them if it rose by more than DRIFT_THRESHOLD.
+    """
+    if not paths:
+        return 0.0, 0.0
+    key = f"{os.path.abspath(folder)}|{nucleus}|{nmr_format}"
+    newest = data_processing.extract_date_time(paths[-1]).isoformat()
+    with _phase_lock:
+        phases = load_phases()
+        stored = phases.get(key)
+        if stored is not None and stored['checked'] >= newest:
+            return stored['p0'], stored['p1']
+
+        if stored is not None:
+            latest = coadd(paths[-PHASE_SAMPLES:], nmr_format)
+            drift = phase_error(latest, stored['p0'], stored['p1']) - stored['error']
+            if drift <= DRIFT_THRESHOLD:
+                stored['checked'] = newest
+                save_phases(phases)
+                return stored['p0'], stored['p1']
+            print(f"Phase drifted by {drift:.3f}, estimating it again")
+            spectrum = latest
+        else:
+            sample = [paths[i] for i in np.unique(np.linspace(0, len(paths) - 1, PHASE_SAMPLES).astype(int))]
+            spectrum = coadd(sample, nmr_format)
+
+        p0, p1 = estimate_phase(spectrum)
+        print(f"Series phase for {key}: p0={p0}, p1={p1}")
+        phases[key] = {'p0': p0, 'p1': p1, 'error': phase_error(spectrum, p0, p1), 'checked': newest}
+        save_phases(phases)
+        return p0, p1
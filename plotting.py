@@ -1,7 +1,7 @@
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 import data_processing
-import nmrglue as ng
+import decimation
 import os
 import numpy as np
 import pandas as pd
@@ -13,11 +13,14 @@ def create_nmr_heatmap(ppm_values, nmr_times, heatmap_intensity, experiment_star
     # Calculate time since the start of the experiment
     time_since_start = [(t - experiment_start_time).total_seconds() / 3600 for t in nmr_times]  # Time in hours
 
+    # Bin the stack down to the pixels it is drawn on, keeping the peak maxima
+    x, y, z = decimation.rasterize(ppm_values, time_since_start, heatmap_intensity)
+
     # Add heatmap trace
     fig.add_trace(go.Heatmap(
-        x=ppm_values,
-        y=time_since_start,
-        z=heatmap_intensity,
+        x=x,
+        y=y,
+        z=z,
         colorscale='Viridis',
         showscale=False
     ))
@@ -46,24 +49,36 @@ def create_nmr_heatmap(ppm_values, nmr_times, heatmap_intensity, experiment_star
     return fig
 
 
+def voltage_trace_points(df, experiment_start_time, hours_range=None, max_points=decimation.MAX_POINTS):
+    """Voltage and Q_minus_Q0 against experiment time (h), each decimated to max_points.
+
+    With hours_range only the samples inside that zoomed range are decimated, so zooming in shows full detail.
+    """
+    hours = ((df['Timestamp'] - experiment_start_time).dt.total_seconds() / 3600).to_numpy()
+    rows = slice(None) if hours_range is None else decimation.window(hours, *hours_range)
+    voltage_hours, voltage = decimation.decimate(hours[rows], df['Voltage'].to_numpy()[rows], max_points)
+    q_hours, q = decimation.decimate(hours[rows], df['Q_minus_Q0'].to_numpy()[rows], max_points)
+    return (voltage, voltage_hours), (q, q_hours)
+
+
 def create_voltage_trace(df, experiment_start_time):
-    # Calculate time since the start of the experiment
-    df['time_since_start'] = (df['Timestamp'] - experiment_start_time).dt.total_seconds() / 3600
+    # Time since the start of the experiment, reduced to a fixed number of points per trace
+    (voltage, voltage_hours), (q, q_hours) = voltage_trace_points(df, experiment_start_time)
 
     fig = make_subplots(specs=[[{"secondary_y": True}]])
 
     # Add voltage trace
     fig.add_trace(go.Scatter(
-        x=df['Voltage'],
-        y=df['time_since_start'],  # Use time since start
+        x=voltage,
+        y=voltage_hours,  # Use time since start
         mode='lines',
         #name='Voltage Trace'
     ), secondary_y=False)
 
     # Add Q_minus_Q0 trace
     fig.add_trace(go.Scatter(
-        x=df['Q_minus_Q0'],
-        y=df['time_since_start'],  # Use time since start
+        x=q,
+        y=q_hours,  # Use time since start
         mode='lines',
         line=dict(color='blue'),
         #name='Q_minus_Q0 Trace'
@@ -83,29 +98,17 @@ def create_voltage_trace(df, experiment_start_time):
     return fig
 
 
-def create_spectra_fig(first_spectrum_path, last_spectrum_path, format_type, nmr_start_time, nmr_end_time):
+def create_spectra_fig(stack, nmr_start_time, nmr_end_time):
     spectra_fig = go.Figure()
 
-    for idx, path in enumerate([first_spectrum_path, last_spectrum_path]):
-        if path:
-            dic, data, p0, p1, runtime, obs, sw, car = data_processing.process_nmr_data(
-                path=path,
-                nmr_format=format_type,
-                apply_autophase=True,
-                p0=0,
-                p1=0
-            )
-            uc = ng.pipe.make_uc(dic, data)
-            ppm = uc.ppm_scale()
-            intensity = data.real
-
-            spectra_fig.add_trace(go.Scatter(
-                x=list((ppm)),
-                y=intensity, mode='lines',
-                name=f'Spectrum {idx + 1} ({os.path.basename(path)})')
-            )
-
-            spectra_fig.update_xaxes(autorange="reversed")
+    for idx, (path, intensity) in enumerate(zip(stack.paths, stack.data)):
+        spectra_fig.add_trace(go.Scatter(
+            x=stack.ppm,
+            y=intensity, mode='lines',
+            name=f'Spectrum {idx + 1} ({os.path.basename(path)})')
+        )
+
+        spectra_fig.update_xaxes(autorange="reversed")
 
     spectra_fig.update_layout(
         title=f"First and Last NMR Spectra ({nmr_start_time.strftime('%Y-%m-%d %H:%M:%S')} - {nmr_end_time.strftime('%Y-%m-%d %H:%M:%S')})",
@@ -115,16 +118,26 @@ def create_spectra_fig(first_spectrum_path, last_spectrum_path, format_type, nmr
 
     return spectra_fig
 
-def create_3d_fid_plot(base_dir, format_type):
+def fid_trace_points(data, sw, time_range=None, max_points=decimation.MAX_POINTS):
+    """Acquisition time (s) and real FID, decimated to max_points within the optional zoomed time_range."""
+    time_points = np.linspace(0, len(data)/sw, len(data))
+    rows = slice(None) if time_range is None else decimation.window(time_points, *time_range)
+    return decimation.decimate(time_points[rows], data.real[rows], max_points)
 
-    dic, data, sw, obs, car, label, runtime = data_processing.read_nmr_data_lowmem(base_dir, format_type)
 
-    time_points = np.linspace(0, len(data)/sw, len(data))
+def create_3d_fid_plot(base_dir, format_type, fid=None):
+
+    # fid is the read_nmr_data_lowmem result when the caller already read the FID
+    if fid is None:
+        fid = data_processing.read_nmr_data_lowmem(base_dir, format_type)
+    dic, data, sw, obs, car, label, runtime = fid
+
+    time_points, intensity = fid_trace_points(data, sw)
 
     # Create a 3D scatter plot
     fid_fig = go.Figure(data=[go.Scatter(
         x=time_points,   # Time
-        y=data.real,     # Real part of the FID
+        y=intensity,     # Real part of the FID
         #z=data.imag,     # Imaginary part of the FID
         mode='lines',
         #marker=dict(
@@ -139,9 +152,10 @@ def create_3d_fid_plot(base_dir, format_type):
     return fid_fig
 
 
-def plot_capacities_and_efficiency_eclab(directory):
-    processed_df = data_processing.process_eclab(directory)
-    processed_df = processed_df[0]
+def plot_capacities_and_efficiency_eclab(directory, eclab_data=None):
+    if eclab_data is None:
+        eclab_data = data_processing.process_eclab(directory)
+    processed_df = eclab_data[0]
 
     # Create subplots: one y-axis for capacities, another for Coulombic Efficiency
     fig = make_subplots(specs=[[{"secondary_y": True}]])
@@ -0,0 +1,75 @@
+import catalog
+import data_processing
+import phasing
+
+
+class RefreshContext:
+    """Data shared by the panels of one dashboard refresh, so each is loaded at most once per refresh.
+
+    The folder is listed with a single catalog refresh, every spectrum is processed with the one series phase
+    (no panel runs its own autophase), and processed spectra, raw FIDs and the ECLab frames are memoized.
+    """
+
+    def __init__(self, nmr_folder, nucleus, nmr_format, voltage_folder=None):
+        self.nmr_folder = nmr_folder
+        self.nucleus = nucleus
+        self.nmr_format = nmr_format
+        self.voltage_folder = voltage_folder
+        self.catalog = catalog.get_catalog(nmr_folder)
+        self.paths = []
+        self._phase = None
+        self._spectra = {}
+        self._fids = {}
+        self._eclab = None
+
+    def latest(self):
+        """Time of the newest spectrum of any nucleus."""
+        return self.catalog.latest()
+
+    def select(self, start_datetime, end_datetime):
+        """Set and return the spectra of the refresh, in time order."""
+        self.paths = self.catalog.spectra_in_range(start_datetime, end_datetime, self.nucleus)
+        return self.paths
+
+    def first_last(self):
+        """First and last spectrum of the nucleus in the whole folder."""
+        return self.catalog.first_last(self.nucleus)
+
+    def start_time(self):
+        """Time of the first spectrum of the nucleus, the zero of the experiment time axis."""
+        earliest = self.catalog.earliest(self.nucleus)
+        if earliest is None:
+            raise ValueError("No valid spectra found in the specified folder.")
+        return earliest
+
+    def phase(self):
+        """Series (p0, p1) of the selected spectra."""
+        if self._phase is None:
+            self._phase = phasing.series_phase(self.nmr_folder, self.nucleus, self.nmr_format, self.paths)
+        return self._phase
+
+    def spectra(self, paths, roi=None, progress=None):
+        """(meta, data) of every path processed with the series phase, cut to roi if given.
+
+        progress(done, total) is passed on to data_processing.process_spectra.
+        """
+        missing = [path for path in dict.fromkeys(paths) if (path, roi) not in self._spectra]
+        if missing:
+            p0, p1 = self.phase()
+            results = data_processing.process_spectra(missing, self.nmr_format, apply_autophase=False, p0=p0, p1=p1,
+                                                      roi=roi, progress=progress)
+            for path, result in zip(missing, results):
+                self._spectra[(path, roi)] = result
+        return [self._spectra[(path, roi)] for path in paths]
+
+    def fid(self, path):
+        """Raw FID of a spectrum as returned by data_processing.read_nmr_data_lowmem."""
+        if path not in self._fids:
+            self._fids[path] = data_processing.read_nmr_data_lowmem(path, self.nmr_format)
+        return self._fids[path]
+
+    def eclab(self):
+        """(processed_cycle_df, processed_voltage_df) of the voltage folder."""
+        if self._eclab is None:
+            self._eclab = data_processing.process_eclab(self.voltage_folder)
+        return self._eclab
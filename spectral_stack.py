@@ -0,0 +1,108 @@
+import bisect
+import numpy as np
+import data_processing
+
+
+class SpectralStack:
+    """Spectra of one series as a contiguous 2D array, one row per spectrum in time order, with its ppm axis.
+
+    The rows live in a buffer with room to grow, so appending spectra and dropping the oldest ones does not copy
+    the stack, and ppm windows are views of the same buffer.
+    """
+
+    def __init__(self, ppm=None, dtype=np.float32):
+        self.ppm = ppm
+        self.dtype = np.dtype(dtype)
+        self.paths = []
+        self.times = []
+        self._buffer = None
+        self._start = 0
+        self._table = None
+
+    @classmethod
+    def from_results(cls, paths, results, dtype=np.float32):
+        """Stack of the spectra returned by data_processing.process_spectra, complex dtypes keep the imaginary part."""
+        stack = cls(dtype=dtype)
+        stack.extend(paths, results)
+        return stack
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def data(self):
+        """2D array of the spectra, one row per entry of self.times."""
+        if self._buffer is None:
+            return np.empty((0, 0 if self.ppm is None else len(self.ppm)), dtype=self.dtype)
+        return self._buffer[self._start:self._start + len(self.paths)]
+
+    def extend(self, paths, results):
+        """Append processed spectra, results as returned by data_processing.process_spectra."""
+        rows = []
+        for meta, data in results:
+            if self.ppm is None:
+                self.ppm = meta.ppm_scale()
+            rows.append(data if self.dtype.kind == 'c' else data.real)
+        if not rows:
+            return
+
+        n_old = len(self.paths)
+        n_total = n_old + len(rows)
+        if self._buffer is None or self._start + n_total > self._buffer.shape[0]:
+            # Out of room, move the rows to a buffer twice the size so appends stay amortized O(1)
+            buffer = np.empty((max(n_total, 2 * n_old), len(self.ppm)), dtype=self.dtype)
+            buffer[:n_old] = self.data
+            self._buffer, self._start = buffer, 0
+        for row, data in zip(self._buffer[self._start + n_old:self._start + n_total], rows):
+            row[...] = data
+
+        self.paths.extend(paths)
+        self.times.extend(data_processing.extract_date_time(path) for path in paths)
+        self._table = None
+
+        # Spectra normally arrive in order, only re-sort when one turned up late. The sorted rows go to a new
+        # buffer, windows handed out earlier share the old one and must keep showing the rows they were made of.
+        if any(a > b for a, b in zip(self.times, self.times[1:])):
+            order = sorted(range(len(self.times)), key=self.times.__getitem__)
+            self.paths = [self.paths[i] for i in order]
+            self.times = [self.times[i] for i in order]
+            buffer = np.empty_like(self._buffer)
+            buffer[:n_total] = self.data[order]
+            self._buffer, self._start = buffer, 0
+
+    def drop_before(self, start_datetime):
+        """Forget spectra older than start_datetime, the remaining rows are not moved."""
+        keep = bisect.bisect_left(self.times, start_datetime)
+        del self.paths[:keep]
+        del self.times[:keep]
+        self._start += keep
+        if self._table is not None:
+            self._table = self._table[keep:]
+
+    def ppm_slice(self, ppm_min, ppm_max):
+        """Slice of the ppm axis with ppm_min <= ppm <= ppm_max, for an ascending or descending axis."""
+        return data_processing.ppm_window_slice(self.ppm, ppm_min, ppm_max)
+
+    def window(self, ppm_min, ppm_max):
+        """Stack restricted to ppm_min..ppm_max, a view that shares the rows of this stack and must not be extended."""
+        columns = self.ppm_slice(ppm_min, ppm_max)
+        view = SpectralStack(self.ppm[columns], self.dtype)
+        view.paths = list(self.paths)
+        view.times = list(self.times)
+        if self._buffer is not None:
+            view._buffer = self._buffer[:, columns]
+            view._start = self._start
+        return view
+
+    def integral_table(self):
+        """Cumulative trapezoid integral of |spectrum| along the ppm axis, one row per spectrum.
+
+        Built on first use and kept until spectra are appended, so every region after the first is a lookup.
+        """
+        if self._table is None:
+            self._table = data_processing.integral_table(self.data, self.ppm)
+        return self._table
+
+    def integrate(self, integration_limits):
+        """Integrate |spectrum| over every (name, start, end) region, one integral per row."""
+        return data_processing.integrate_regions(self.integral_table(), self.ppm, integration_limits)
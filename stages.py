@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import catalog
+import data_processing
+import spectral_stack
+import utils
+
+# Data stages kept in memory, the least recently used is dropped first. The browser only holds their handles.
+MAX_STAGES = 64
+
+_stages = OrderedDict()
+_stages_lock = threading.Lock()
+
+
+class StageLost(Exception):
+    """Raised when a dropped stage cannot be built again because its data changed since the handle was made."""
+
+
+def stage_handle(name, *inputs):
+    """Handle of a stage, the same stage with the same inputs always gets the same handle."""
+    return f"{name}:{utils.generate_uid(name, *inputs)}"
+
+
+def fetch(handle, build):
+    """Stage stored under handle, build() is stored under it first when that stage is not in memory."""
+    with _stages_lock:
+        if handle in _stages:
+            _stages.move_to_end(handle)
+            return _stages[handle]
+    value = build()
+    with _stages_lock:
+        _stages[handle] = value
+        while len(_stages) > MAX_STAGES:
+            _stages.popitem(last=False)
+    return value
+
+
+def memoize(handle, build):
+    """Return handle, storing build() under it unless that stage is already in memory."""
+    fetch(handle, build)
+    return handle
+
+
+def spectra_handle(selection, nmr_format, phase, roi):
+    """Handle of the stack of the selected spectra processed with the series phase and cut to roi."""
+    return stage_handle('spectra', selection, nmr_format, tuple(phase), tuple(roi))
+
+
+# The panels only hold the handle dicts returned by a refresh. A stage that was dropped since is built again
+# from the inputs in its dict and stored under the same handle.
+
+def selection(handle, nmr_folder, nucleus, start, end):
+    """Paths of a selection stage, listed again from the catalog if it was dropped."""
+    def build():
+        paths = catalog.get_catalog(nmr_folder).spectra_in_range(start, end, nucleus)
+        if stage_handle('selection', nmr_folder, nucleus, paths) != handle:
+            raise StageLost(handle)
+        return paths
+    return fetch(handle, build)
+
+
+def spectra(source, roi):
+    """Stack of the spectra of a spectra_handle dict for any roi, processed only the first time it is asked for."""
+    def build():
+        paths = selection(source['selection'], source['nmr_folder'], source['nucleus'],
+                          datetime.fromisoformat(source['start']), datetime.fromisoformat(source['end']))
+        results = data_processing.process_spectra(paths, source['format_type'], apply_autophase=False,
+                                                  p0=source['phase'][0], p1=source['phase'][1], roi=tuple(roi))
+        return spectral_stack.SpectralStack.from_results(paths, results)
+    return fetch(spectra_handle(source['selection'], source['format_type'], source['phase'], roi), build)
+
+
+def eclab(source):
+    """ECLab frames of a voltage_handle or cycle_handle dict, read again from the folder if they were dropped."""
+    return fetch(source['frames'], lambda: data_processing.process_eclab(source['voltage_folder']))
+
+
+def first_last(source):
+    """Stack of the first and last spectrum of a first_last_handle dict."""
+    def build():
+        paths = source['paths']
+        results = data_processing.process_spectra(paths, source['format_type'], apply_autophase=False,
+                                                  p0=source['phase'][0], p1=source['phase'][1])
+        return spectral_stack.SpectralStack.from_results(paths, results)
+    return fetch(source['handle'], build)
+
+
+def fid(source):
+    """Raw FID of a fid_handle dict as returned by data_processing.read_nmr_data_lowmem."""
+    return fetch(source['handle'], lambda: data_processing.read_nmr_data_lowmem(source['path'],
+                                                                               source['format_type']))
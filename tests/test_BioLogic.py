@@ -0,0 +1,66 @@
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from galvani_mod import BioLogic  # noqa: E402
+
+COLUMN_IDS = [4, 6, 13]
+
+
+def write_mpr(file_path, n_records):
+    """Write a minimal MPR file with a version 2 data module of n_records records"""
+    dtype, _ = BioLogic.VMPdata_dtype_from_colIDs(COLUMN_IDS)
+    records = np.zeros(n_records, dtype=dtype)
+    records["time/s"] = np.arange(n_records, dtype=float)
+    records["Ewe/V"] = 3.0
+    head = struct.pack("<IB", n_records, len(COLUMN_IDS)) + struct.pack("<3H", *COLUMN_IDS)
+    body = head.ljust(405, b"\x00") + records.tobytes()
+    header = b"VMP data  " + b"Data".ljust(25) + struct.pack("<II", len(body), 2) + b"11/18/23"
+    with open(file_path, "wb") as mpr_file:
+        mpr_file.write(BioLogic.MPR_MAGIC + b"MODULE" + header + body)
+    return records
+
+
+class TestMPRfileUpdate(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cell.mpr")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_update_reads_appended_records(self):
+        write_mpr(self.path, 100)
+        mpr = BioLogic.MPRfile(self.path, memory_map=True, columns=["time/s", "Ewe/V"])
+        records = write_mpr(self.path, 150)
+        self.assertEqual(mpr.update(), 50)
+        np.testing.assert_array_equal(mpr.data["time/s"], records["time/s"])
+
+    def test_update_after_truncation_never_reads_past_the_file(self):
+        # A truncated memory-mapped view raises SIGBUS when read, which kills the process
+        write_mpr(self.path, 200000)
+        mpr = BioLogic.MPRfile(self.path, memory_map=True, columns=["time/s", "Ewe/V"])
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as mpr_file:
+            mpr_file.truncate(size // 2)
+
+        # The point count in the header still says 200000 records, the file can not be read yet
+        with self.assertRaises(Exception):
+            mpr.update()
+        self.assertEqual(len(pd.DataFrame(mpr.data)), 0)
+
+        # Once it is rewritten completely, the next update reads it again
+        records = write_mpr(self.path, 1000)
+        self.assertEqual(mpr.update(), 1000)
+        frame = pd.DataFrame(mpr.data)
+        np.testing.assert_array_equal(frame["time/s"], records["time/s"])
+
+
+if __name__ == "__main__":
+    unittest.main()
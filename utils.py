@@ -2,46 +2,21 @@ import datetime
 import os
 import pandas as pd
 import hashlib
-import data_processing
+import catalog
 
 
 def get_most_recent_time(directory):
-    most_recent_time = None
-    for root, dirs, files in os.walk(directory):
-        for dir_name in dirs:
-            if dir_name.endswith(".fid"):
-                try:
-                    # Extract the date and time part from the directory name
-                    date_time_str = dir_name.split('_')[1].split('.')[0]
-                    file_date_time = datetime.datetime.strptime(date_time_str, "%Y%m%dT%H%M%S")
-                    if most_recent_time is None or file_date_time > most_recent_time:
-                        most_recent_time = file_date_time
-                except (IndexError, ValueError):
-                    # Skip if the date and time cannot be extracted
-                    continue
-    return most_recent_time
+    return catalog.get_catalog(directory).latest()
 
 
 def find_first_last_spectra(directory, nucleus):
-    spectra_paths = []
-    for root, dirs, files in os.walk(directory):
-        for dir_name in dirs:
-            if dir_name.startswith(nucleus) and dir_name.endswith(".fid"):
-                file_path = os.path.join(root, dir_name)
-                spectra_paths.append(file_path)
-
-    if not spectra_paths:
-        return None, None
-
-    # Sort the spectra based on their filenames
-    spectra_paths.sort()
-    return spectra_paths[0], spectra_paths[-1]  # Return first and last spectra
+    # Return first and last spectra
+    return catalog.get_catalog(directory).first_last(nucleus)
 
 def identify_eclab_files(directory):
-    contents = os.listdir(directory)
-
     mpr_file = None
     mpl_file = None
+    mpt_file = None
     for file in os.listdir(directory):
         if file.endswith('.mpr'):
             mpr_file = os.path.join(directory, file)
@@ -49,10 +24,14 @@ def identify_eclab_files(directory):
         elif file.endswith('.mpl'):
             mpl_file = os.path.join(directory, file)
             print('MPL found')
-    if not mpr_file:
-        raise FileNotFoundError("MPR file not found in the provided folder.")
+        elif file.endswith('.mpt'):
+            mpt_file = os.path.join(directory, file)
+            print('MPT found')
+    if not mpr_file and not mpt_file:
+        raise FileNotFoundError("No MPR or MPT file found in the provided folder.")
 
-    return mpr_file, mpl_file
+    # The binary MPR file is preferred, the MPT text export is the fallback
+    return mpr_file, mpl_file, mpt_file
 
 
 def generate_uid(path, nucleus, *args):
@@ -64,6 +43,18 @@ def generate_uid(path, nucleus, *args):
 
     return uid
 
+def spectrum_fingerprint(path):
+    # Size and modification time of the raw acquisition files, so a rewritten fid/procpar gets a new cache key
+    parts = []
+    for name in ('fid', 'procpar', 'acqus'):
+        file_path = os.path.join(path, name)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return ";".join(parts)
+
 def generate_text_content(integrated_values, times):
     content = "Timestamp, Integrated Value\n"
     for time, value in zip(times, integrated_values):
@@ -71,14 +62,9 @@ def generate_text_content(integrated_values, times):
     return content
 
 def find_true_start_time(nmr_folder, nucleus):
-    # List all files in the NMR folder
-    all_files = [os.path.join(nmr_folder, f) for f in os.listdir(nmr_folder) if f.endswith(".fid")]
-
-    # Extract timestamps from all files
-    timestamps = [data_processing.extract_date_time(f) for f in all_files if nucleus in f]
-
     # Return the earliest timestamp
-    if timestamps:
-        return min(timestamps)
+    earliest = catalog.get_catalog(nmr_folder).earliest(nucleus)
+    if earliest is not None:
+        return earliest
     else:
-        raise ValueError("No valid spectra found in the specified folder.")
\ No newline at end of file
+        raise ValueError("No valid spectra found in the specified folder.")
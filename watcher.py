@@ -0,0 +1,188 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import threading
+import time
+import catalog
+import data_processing
+import utils
+
+# Seconds between two looks at the folders when inotify is not available
+POLL_SECONDS = 2.0
+# A new spectrum is reported once its fid and procpar stayed the same for this long, VNMRJ writes them in steps
+SETTLE_SECONDS = 1.0
+# Growth of the ECLab files alone is reported at most this often, the cycler writes them continuously
+ECLAB_SECONDS = 30.0
+# With inotify the folders are still looked at this often, in case an event was missed
+SAFETY_SECONDS = 60.0
+# A watcher that no browser asked for in this long stops
+IDLE_SECONDS = 600.0
+
+# inotify event mask, see inotify(7)
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+class Inotify:
+    """Minimal inotify binding through ctypes, only used to wake up when a watched directory changed."""
+
+    def __init__(self, libc, fd):
+        self._libc = libc
+        self._fd = fd
+        self._watched = {}
+
+    @classmethod
+    def create(cls):
+        """Inotify instance, None where the platform or libc does not provide inotify."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+    def watch(self, path):
+        if path in self._watched:
+            return
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self._watched[path] = wd
+
+    def unwatch(self, path):
+        wd = self._watched.pop(path, None)
+        if wd is not None:
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for events, returns True when any arrived. The events are discarded."""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self._fd)
+
+
+class FolderWatcher(threading.Thread):
+    """Watches an NMR folder for new .fid directories and a voltage folder for growing ECLab files.
+
+    version changes only when data actually arrived. The catalog and the ECLab frames are brought up to date
+    before it changes, so the refresh it triggers finds the new data already ingested.
+    """
+
+    def __init__(self, nmr_folder, voltage_folder):
+        super().__init__(name=f'watcher {nmr_folder}', daemon=True)
+        self.nmr_folder = nmr_folder
+        self.voltage_folder = voltage_folder
+        self.count = 0
+        self.last_used = time.time()
+
+    @property
+    def version(self):
+        return f"{self.nmr_folder}|{self.voltage_folder}|{self.count}"
+
+    def spectra_signature(self):
+        """Number of spectra, the newest one and the size and time of its files."""
+        spectrum_catalog = catalog.get_catalog(self.nmr_folder)
+        newest = spectrum_catalog.newest()
+        return len(spectrum_catalog), newest, utils.spectrum_fingerprint(newest) if newest else None
+
+    @staticmethod
+    def complete(spectra):
+        """False while the newest spectrum directory exists but its fid (or Bruker ser) has not been written yet."""
+        newest = spectra[1]
+        return newest is None or any(os.path.exists(os.path.join(newest, name)) for name in ('fid', 'ser'))
+
+    def eclab_signature(self):
+        if not self.voltage_folder:
+            return None
+        try:
+            return data_processing.eclab_folder_key(self.voltage_folder)
+        except OSError:
+            return None
+
+    def report(self):
+        if self.voltage_folder:
+            try:
+                data_processing.process_eclab(self.voltage_folder)
+            except Exception as e:
+                print(f"Error reading ECLab data of {self.voltage_folder}: {e}")
+        self.count += 1
+        print(f"New data in {self.nmr_folder}, version {self.count}")
+
+    def run(self):
+        notify = Inotify.create()
+        if notify is None:
+            print(f"inotify not available, checking {self.nmr_folder} every {POLL_SECONDS} s")
+        reported_spectra = reported_eclab = observed_spectra = watched_spectrum = None
+        reported_at = 0.0
+        try:
+            while time.time() - self.last_used < IDLE_SECONDS:
+                spectra = self.spectra_signature()
+                eclab = self.eclab_signature()
+                if notify is not None:
+                    for directory in catalog.get_catalog(self.nmr_folder).directories():
+                        notify.watch(directory)
+                    if self.voltage_folder and os.path.isdir(self.voltage_folder):
+                        notify.watch(self.voltage_folder)
+                    # The files of the newest spectrum are written after its directory appears
+                    if spectra[1] != watched_spectrum:
+                        if watched_spectrum is not None:
+                            notify.unwatch(watched_spectrum)
+                        if spectra[1] is not None:
+                            notify.watch(spectra[1])
+                        watched_spectrum = spectra[1]
+
+                timeout = POLL_SECONDS if notify is None else SAFETY_SECONDS
+                if spectra != reported_spectra:
+                    if spectra == observed_spectra and self.complete(spectra):
+                        reported_spectra, reported_eclab, reported_at = spectra, eclab, time.time()
+                        self.report()
+                    else:
+                        # Look again once the newest spectrum had time to be written completely
+                        timeout = SETTLE_SECONDS
+                elif eclab != reported_eclab:
+                    wait = reported_at + ECLAB_SECONDS - time.time()
+                    if wait <= 0:
+                        reported_eclab, reported_at = eclab, time.time()
+                        self.report()
+                    else:
+                        timeout = min(timeout, wait)
+                observed_spectra = spectra
+
+                if notify is None:
+                    time.sleep(timeout)
+                else:
+                    notify.wait(timeout)
+        finally:
+            if notify is not None:
+                notify.close()
+
+
+def get_watcher(nmr_folder, voltage_folder=None):
+    """Running watcher of an NMR and voltage folder, started on first use and stopped when no longer asked for."""
+    key = (os.path.normpath(nmr_folder), os.path.normpath(voltage_folder) if voltage_folder else None)
+    with _watchers_lock:
+        watcher = _watchers.get(key)
+        if watcher is None or not watcher.is_alive():
+            watcher = _watchers[key] = FolderWatcher(*key)
+            watcher.start()
+        watcher.last_used = time.time()
+    return watcher